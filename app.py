@@ -14,29 +14,84 @@ Update on May 02 to reflect Databricks API Changes https://www.databricks.com/bl
 """
 
 import os
-import json
+import atexit
+import queue
+import orjson
 import logging
+from logging.handlers import QueueHandler, QueueListener
 import time
 import tempfile
 import csv
-from typing import Dict, List, Optional
+import gzip
+import io
+from typing import Callable, Dict, List, Optional
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import chain
+from types import MappingProxyType
+from weakref import WeakValueDictionary
+from cachetools import LRUCache, TTLCache
 from dotenv import load_dotenv
+import aiohttp
 from aiohttp import web
 from botbuilder.core import BotFrameworkAdapterSettings, BotFrameworkAdapter, ActivityHandler, TurnContext, MessageFactory
 from botbuilder.schema import Activity, ChannelAccount, Attachment, ActivityTypes
 from databricks.sdk import WorkspaceClient
+from databricks.sdk.config import Config
 from databricks.sdk.service.dashboards import GenieAPI, MessageStatus
 import asyncio
-import requests
+import random
 import re
 import html
 # RE-ENABLE FOR EMAIL GRAPH SOLUTION
 import base64
 from urllib.parse import urlencode, quote
 from contextlib import suppress
+from concurrent.futures import ThreadPoolExecutor
 import sqlparse
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from supervisor import supervisor_summarize, supervisor_insights
-from storage import save_user_profile, save_user_pref, get_user_prefs, clear_user_pref
+from storage import save_user_profile_background, save_user_pref, get_user_prefs, clear_user_pref
+
+def _jdumps(obj) -> str:
+    """orjson-backed json.dumps replacement returning str."""
+    return orjson.dumps(obj).decode()
+
+_jloads = orjson.loads
+
+
+def _unlink_quietly(path) -> None:
+    with suppress(OSError):
+        os.unlink(path)
+
+
+class _CsvFileCache(TTLCache):
+    """
+    TTLCache of session -> temp CSV path that deletes the file when its entry
+    is evicted (size or TTL) or replaced.
+    """
+
+    def __setitem__(self, key, value):
+        old = self.get(key)
+        super().__setitem__(key, value)
+        if old and old != value:
+            _unlink_quietly(old)
+
+    def popitem(self):
+        key, path = super().popitem()
+        _unlink_quietly(path)
+        return key, path
+
+    def expire(self, time=None):
+        expired = super().expire(time) or ()
+        for _, path in expired:
+            _unlink_quietly(path)
+        return expired
+
+    def unlink_all(self):
+        for path in list(self.values()):
+            _unlink_quietly(path)
 
 # Env vars
 load_dotenv()
@@ -47,9 +102,14 @@ DATABRICKS_TOKEN = os.getenv("DATABRICKS_TOKEN")
 APP_ID = os.getenv("MicrosoftAppId", "")
 APP_PASSWORD = os.getenv("MicrosoftAppPassword", "")
 MAX_ROWS = 200
-SESSION_FILES: Dict[str, str] = {}
+SESSION_TTL = 3600  # seconds to keep a session's CSV / Genie JSON around
+SESSION_MAX = 1000
+SESSION_FILES: _CsvFileCache = _CsvFileCache(maxsize=SESSION_MAX, ttl=SESSION_TTL)
+atexit.register(SESSION_FILES.unlink_all)
+# session -> CSV write still in progress (its path lands in SESSION_FILES when done)
+CSV_TASKS: Dict[str, asyncio.Task] = {}
 # In‑memory store for full Genie JSON per session
-SESSION_DATA: Dict[str, Dict] = {}
+SESSION_DATA: TTLCache = TTLCache(maxsize=SESSION_MAX, ttl=SESSION_TTL)
 DASH_URL = os.environ["DASH_URL"]
 BOT_URL = os.environ["BOT_URL"]
 DATABRICKS_WAREHOUSE_ID = os.getenv("SQL_WAREHOUSE_ID")
@@ -61,38 +121,110 @@ MS_CLIENT_SECRET = os.getenv("MicrosoftAppPassword", "")
 MS_TENANT_ID     = os.getenv("MS_TENANT_ID")  # or your tenant GUID
 MS_REDIRECT_URI  = os.getenv("MS_REDIRECT_URI")         # e.g. https://<bot-host>/graph/callback
 MS_SCOPES        = "openid profile offline_access Mail.ReadWrite User.Read.All"
-GRAPH_TOKENS: Dict[str, Dict[str, str]] = {}
+@dataclass(slots=True)
+class TokenInfo:
+    access_token: str
+    refresh_token: str
+    expires_at: int   # epoch seconds, already 60s ahead of the real expiry
+
+# user_id -> TokenInfo; LRU (no TTL) so refresh tokens survive idle users
+GRAPH_TOKENS: LRUCache = LRUCache(maxsize=1024)
 # OWA_MAX_URL_LEN = 1400  # keep the final URL comfortably below Safe Links limits
 PREVIEW_MAX_ROWS = 50
 TYPING_INTERVAL = 4.0
+TYPING_MAX_INTERVAL = 30.0   # back-off ceiling when typing sends keep failing
+GENIE_POLL_BUDGET_S = 60.0   # total wall-time allowed for get_message polling
+GENIE_CALL_TIMEOUT_S = 30.0  # per get_message call
+GENIE_BACKOFF_CAP_S = 10.0   # max sleep between polls
+GENIE_HEDGE_DELAY_S = 2.0    # send a second get_message if the first is this slow
+GENIE_MAX_INFLIGHT = int(os.getenv("GENIE_MAX_INFLIGHT", "16"))
+GENIE_SEM = asyncio.Semaphore(GENIE_MAX_INFLIGHT)
+# Dedicated pool for blocking SDK / warehouse calls; sized for a hedge per in-flight call
+GENIE_EXEC = ThreadPoolExecutor(
+    max_workers=int(os.getenv("GENIE_POOL", str(2 * GENIE_MAX_INFLIGHT))),
+    thread_name_prefix="genie",
+)
 DRAFT_CACHE_TTL = 120  # seconds to treat a draft as 'recent'
-DRAFTS_BY_KEY: dict[str, dict] = {}
+DRAFTS_BY_KEY: TTLCache = TTLCache(maxsize=5000, ttl=DRAFT_CACHE_TTL)  # expiry is the 'recent' check
+SUMMARY_CACHE_TTL = 3600  # seconds to reuse a supervisor summary for the same statement
+# statement_id -> supervisor_summarize result; a retried draft doesn't re-bill the LLM
+SUMMARY_CACHE: TTLCache = TTLCache(maxsize=512, ttl=SUMMARY_CACHE_TTL)
+CONVERSATION_CACHE_MAX = 100_000
+CONVERSATION_TTL = 24 * 3600  # seconds before a user's Genie conversation is forgotten
+# single-flight: (space_id, conversation_id, aad_id, composed prompt) -> the one
+# in-flight _ask_genie task for it. Finished answers are not kept: the card's
+# chart/email/CSV actions read SESSION_DATA/SESSION_FILES for the conversation,
+# which only the call that actually ran has populated.
+GENIE_INFLIGHT: dict[tuple, asyncio.Future] = {}
+# conversation_id -> lock; Genie turns in one conversation run one at a time
+# Weak values: a lock lives as long as some turn holds or waits on it, so a
+# turn outlasting any TTL (create_message_and_wait may take 20 min) keeps it.
+_CONVERSATION_LOCKS: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+STATEMENT_ID_TTL = 300  # seconds to trust a cached attachment statement_id
+# (conversation_id, attachment_id) -> statement_id; saves the message GET per fetch
+STATEMENT_IDS: TTLCache = TTLCache(maxsize=1024, ttl=STATEMENT_ID_TTL)
 LLM_SUPERVISOR_INSIGHTS_ENABLED = os.getenv("LLM_SUPERVISOR_INSIGHTS_ENABLED", "0") == "1"
 EXPLICIT_INTENT = re.compile(
     r"\b(remember|set|save|store|make\s+(?:it\s+)?(?:my\s+)?default|default\s+to|prefer|use)\b",
     re.IGNORECASE,)
 CLEAR_INTENT = re.compile(r"\b(clear|forget|delete|reset)\b", re.IGNORECASE)
 
-VALID_DEPTS =   {"32", "41", "42", "44", "45", "46",
+# Single-word intent vocabularies, checked by set membership on one token scan;
+# the regex above only runs for the multi-word "make ... default" / "default to" forms.
+_TOKEN_RE = re.compile(r"\b\w+\b")
+_EXPLICIT_TOKENS = frozenset({"remember", "set", "save", "store", "prefer", "use"})
+_CLEAR_TOKENS    = frozenset({"clear", "forget", "delete", "reset"})
+
+def _question_tokens(text: str) -> frozenset:
+    return frozenset(_TOKEN_RE.findall(text.lower()))
+
+def has_explicit_intent(text: str, tokens: Optional[frozenset] = None) -> bool:
+    tokens = _question_tokens(text) if tokens is None else tokens
+    if not _EXPLICIT_TOKENS.isdisjoint(tokens):
+        return True
+    return "default" in tokens and EXPLICIT_INTENT.search(text) is not None
+
+def has_clear_intent(text: str, tokens: Optional[frozenset] = None) -> bool:
+    tokens = _question_tokens(text) if tokens is None else tokens
+    return not _CLEAR_TOKENS.isdisjoint(tokens)
+
+VALID_DEPTS: frozenset[str] = frozenset({
+                "32", "41", "42", "44", "45", "46",
                 "51", "52", "53", "55", "61", "63",
                 "64", "66", "67", "82", "83", "84",
-                "85", "86", "91", "93", "95", "96"}
-VALID_DCS =     {"3", "4", "5", "6", "7"}
-VALID_REGIONS = {"FLORIDA", "GREAT LAKES", "MID ATLANTIC",
+                "85", "86", "91", "93", "95", "96"})
+VALID_DCS: frozenset[str] = frozenset({"3", "4", "5", "6", "7"})
+VALID_REGIONS: frozenset[str] = frozenset({
+                "FLORIDA", "GREAT LAKES", "MID ATLANTIC",
                 "MID SOUTH", "MIDWEST", "MOUNTAIN",
                 "NEW YORK CITY METRO", "NORTHEAST",
                 "SOUTH ATLANTIC", "SOUTHEAST", "SOUTHERN",
-                "TEXAS", "WEST"}
+                "TEXAS", "WEST"})
+
+# "Valid values are: ..." strings, built once instead of per error message
+VALID_DEPTS_SORTED_STR = ", ".join(sorted(VALID_DEPTS))
+VALID_DCS_SORTED_STR = ", ".join(sorted(VALID_DCS))
+VALID_REGIONS_SORTED_STR = ", ".join(sorted(VALID_REGIONS))
+VALID_SORTED_STR = {
+    "dept": VALID_DEPTS_SORTED_STR,
+    "dc": VALID_DCS_SORTED_STR,
+    "region": VALID_REGIONS_SORTED_STR,
+}
 
-# Configure root logger
-logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s %(levelname)s %(name)s %(message)s"
-)
+# Configure root logger (LOG_LEVEL=DEBUG to see full Genie payloads)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Handlers write from a background thread; the event loop only enqueues records.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_stream, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(level=LOG_LEVEL, handlers=[QueueHandler(_log_queue)])
 
 # Module-level logger
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 # ---- Genie per-turn instructions (applied on every message) -----------------
 # Toggle with GENIE_INSTRUCTIONS_ENABLED=1 to enable; leave unset/0 to disable.
@@ -144,9 +276,15 @@ Dataset References:
 #     MS_CLIENT_ID, MS_TENANT_ID, MS_REDIRECT_URI
 # )
 
+# Size the SDK's pooled requests session explicitly so concurrent Genie calls
+# reuse warm TLS connections instead of re-handshaking per call.
 workspace_client = WorkspaceClient(
-    host=DATABRICKS_HOST,
-    token=DATABRICKS_TOKEN
+    config=Config(
+        host=DATABRICKS_HOST,
+        token=DATABRICKS_TOKEN,
+        max_connection_pools=50,
+        max_connections_per_pool=100,
+    )
 )
 
 # 2) Register healthz **before** all your other routes
@@ -158,110 +296,199 @@ app.router.add_get("/healthz", healthz)
 
 genie_api = GenieAPI(workspace_client.api_client)
 
-def get_attachment_query_result(space_id, conversation_id, message_id, attachment_id):
-    url = f"{DATABRICKS_HOST}/api/2.0/genie/spaces/{space_id}/conversations/{conversation_id}/messages/{message_id}"
-    headers = {
-        "Authorization": f"Bearer {DATABRICKS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        logger.error(f"Message endpoint returned status {response.status_code}: {response.text}")
-        return {}
-    
+# Shared, pooled HTTP session for the Databricks REST helpers below.
+# Opened on app startup and closed on cleanup so TLS connections are reused.
+HTTP_SESSION: Optional[aiohttp.ClientSession] = None
+HTTP_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+async def _open_http_session(app: web.Application):
+    global HTTP_SESSION
+    HTTP_SESSION = aiohttp.ClientSession(
+        json_serialize=_jdumps,
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=50,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+        )
+    )
+
+async def _close_http_session(app: web.Application):
+    if HTTP_SESSION is not None:
+        await HTTP_SESSION.close()
+
+app.on_startup.append(_open_http_session)
+app.on_cleanup.append(_close_http_session)
+
+HTTP_RETRIES = 3
+_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+
+async def _http_text(method: str, url: str, *, retry: Optional[bool] = None, **kwargs) -> tuple:
+    """
+    Issue a request on the shared session and return (status, body text).
+    Idempotent methods retry connection errors and throttling/gateway statuses
+    with a short backoff; anything else (POSTs: query execution, statement
+    submission, single-use OAuth codes) is sent once unless the caller passes
+    retry=True.
+    """
+    if retry is None:
+        retry = method.upper() in _IDEMPOTENT_METHODS
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    attempts = HTTP_RETRIES if retry else 1
+    for attempt in range(attempts):
+        last = attempt == attempts - 1
+        try:
+            async with HTTP_SESSION.request(method, url, **kwargs) as response:
+                status = response.status
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if last:
+                raise
+        else:
+            if status not in _RETRY_STATUSES or last:
+                return status, text
+        await asyncio.sleep(0.5 * 2 ** attempt)
+
+# Request constants shared by the Databricks REST helpers (read-only)
+DATABRICKS_HEADERS = MappingProxyType({
+    "Authorization": f"Bearer {DATABRICKS_TOKEN}",
+    "Content-Type": "application/json",
+})
+_GENIE_MESSAGE_BASE = (
+    f"{DATABRICKS_HOST}/api/2.0/genie/spaces/{{space_id}}"
+    "/conversations/{conversation_id}/messages/{message_id}"
+)
+_GENIE_MESSAGE_URL = _GENIE_MESSAGE_BASE.format_map
+_GENIE_QUERY_RESULT_URL = (_GENIE_MESSAGE_BASE + "/attachments/{attachment_id}/query-result").format_map
+_GENIE_EXECUTE_QUERY_URL = (
+    f"{DATABRICKS_HOST}/genie/spaces/{{space_id}}"
+    "/conversations/{conversation_id}/messages/{message_id}"
+    "/attachments/{attachment_id}/execute-query"
+).format_map
+
+async def _fetch_attachment_statement_id(ids, attachment_id):
+    """
+    Look up an attachment's statement_id from its message (one extra round trip).
+    """
+    url = _GENIE_MESSAGE_URL(ids)
+    status, text = await _http_text("GET", url, headers=DATABRICKS_HEADERS)
+    if status != 200:
+        logger.error(f"Message endpoint returned status {status}: {text}")
+        return None
+
+    message_data = _jloads(text)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Message data: %s", message_data)
+
+    # lazy scan: stop at the first attachment with our id
+    attachment = next(
+        (a for a in message_data.get("attachments") or () if a.get("attachment_id") == attachment_id),
+        None,
+    )
+    return ((attachment or {}).get("query") or {}).get("statement_id")
+
+
+async def get_attachment_query_result(space_id, conversation_id, message_id, attachment_id, statement_id=None):
+    ids = {"space_id": space_id, "conversation_id": conversation_id, "message_id": message_id}
+    cache_key = (conversation_id, attachment_id)
     try:
-        message_data = response.json()
-        logger.info(f"Message data: {message_data}")
-        
-        statement_id = None
-        if "attachments" in message_data:
-            for attachment in message_data["attachments"]:
-                if attachment.get("attachment_id") == attachment_id:
-                    if "query" in attachment and "statement_id" in attachment["query"]:
-                        statement_id = attachment["query"]["statement_id"]
-                        break
-        
+        # known statement_id (caller or cache) -> go straight to the query result
+        statement_id = statement_id or STATEMENT_IDS.get(cache_key)
+        if not statement_id:
+            statement_id = await _fetch_attachment_statement_id(ids, attachment_id)
         if not statement_id:
             logger.error("No statement_id found in message data")
             return {}
-            
-        query_url = f"{DATABRICKS_HOST}/api/2.0/genie/spaces/{space_id}/conversations/{conversation_id}/messages/{message_id}/attachments/{attachment_id}/query-result"
-        query_headers = {
-            "Authorization": f"Bearer {DATABRICKS_TOKEN}",
-            "Content-Type": "application/json",
-            "X-Databricks-Statement-Id": statement_id
-        }
+        STATEMENT_IDS[cache_key] = statement_id
+
+        query_url = _GENIE_QUERY_RESULT_URL({**ids, "attachment_id": attachment_id})
+        query_headers = {**DATABRICKS_HEADERS, "X-Databricks-Statement-Id": statement_id}
         
-        query_response = requests.get(query_url, headers=query_headers)
-        if query_response.status_code != 200:
-            logger.error(f"Query result endpoint returned status {query_response.status_code}: {query_response.text}")
+        query_status, query_text = await _http_text("GET", query_url, headers=query_headers)
+        if query_status != 200:
+            logger.error(f"Query result endpoint returned status {query_status}: {query_text}")
+            STATEMENT_IDS.pop(cache_key, None)  # possibly stale; re-resolve next time
             return {}
             
-        if not query_response.text.strip():
-            logger.error(f"Empty response from Genie API: {query_response.status_code}")
+        if not query_text.strip():
+            logger.error(f"Empty response from Genie API: {query_status}")
             return {}
             
-        result = query_response.json()
-        logger.info(f"Raw query result response: {result}")
+        result = _jloads(query_text)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw query result response: %s", result)
         
-        if isinstance(result, dict):
-            if "data_array" in result:
-                if not isinstance(result["data_array"], list):
-                    result["data_array"] = []
-            if "schema" in result:
-                if not isinstance(result["schema"], dict):
-                    result["schema"] = {}
-                    
-            if "schema" in result and "columns" in result["schema"]:
-                if not isinstance(result["schema"]["columns"], list):
-                    result["schema"]["columns"] = []
-                    
-            if "data_array" in result and result["data_array"] and "schema" not in result:
-                first_row = result["data_array"][0]
-                if isinstance(first_row, dict):
-                    result["schema"] = {
-                        "columns": [{"name": key} for key in first_row.keys()]
-                    }
-                elif isinstance(first_row, list):
-                    result["schema"] = {
-                        "columns": [{"name": f"Column {i}"} for i in range(len(first_row))]
-                    }
-                    
-        return result
+        return _normalize_query_result(result)
     except Exception as e:
-        logger.error(f"Failed to process Genie API response: {e}, text: {response.text}")
+        logger.error(f"Failed to process Genie API response: {e}")
         return {}
 
 
-# Per-key async locks to avoid race conditions when two hits arrive at once
-_DRAFT_LOCKS: dict[str, asyncio.Lock] = {}
+def _normalize_query_result(result):
+    """
+    Validate the legacy top-level shape (`data_array` / `schema`) of a
+    query-result payload. Genie normally nests rows under
+    `statement_response`, so the common case returns untouched.
+    """
+    if not isinstance(result, dict) or ("data_array" not in result and "schema" not in result):
+        return result
+
+    data_array = result.get("data_array")
+    if data_array is not None and not isinstance(data_array, list):
+        result["data_array"] = data_array = []
+
+    if "schema" not in result:
+        if data_array:
+            first_row = data_array[0]
+            if isinstance(first_row, dict):
+                result["schema"] = {"columns": [{"name": key} for key in first_row]}
+            elif isinstance(first_row, list):
+                result["schema"] = {"columns": [{"name": f"Column {i}"} for i in range(len(first_row))]}
+    elif not isinstance(result["schema"], dict):
+        result["schema"] = {}
+    elif not isinstance(result["schema"].get("columns", []), list):
+        result["schema"]["columns"] = []
+
+    return result
+
+# Per-key async locks to avoid race conditions when two hits arrive at once.
+# A lock lives only while some request holds it, so it can't be evicted mid-use
+# and idle keys cost nothing.
+_DRAFT_LOCKS: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
 def _get_draft_lock(key: str) -> asyncio.Lock:
     lock = _DRAFT_LOCKS.get(key)
-    if not lock:
-        lock = asyncio.Lock()
-        _DRAFT_LOCKS[key] = lock
+    if lock is None:
+        lock = _DRAFT_LOCKS[key] = asyncio.Lock()
     return lock
 
-def execute_attachment_query(space_id, conversation_id, message_id, attachment_id, payload):
-    url = f"{DATABRICKS_HOST}/genie/spaces/{space_id}/conversations/{conversation_id}/messages/{message_id}/attachments/{attachment_id}/execute-query"
-    headers = {
-        "Authorization": f"Bearer {DATABRICKS_TOKEN}",
-        "Content-Type": "application/json"
-    }
-    response = requests.post(url, headers=headers, json=payload)
-    if response.status_code != 200:
-        logger.error(f"Execute query endpoint returned status {response.status_code}: {response.text}")
+async def execute_attachment_query(space_id, conversation_id, message_id, attachment_id, payload):
+    url = _GENIE_EXECUTE_QUERY_URL({
+        "space_id": space_id, "conversation_id": conversation_id,
+        "message_id": message_id, "attachment_id": attachment_id,
+    })
+    status, text = await _http_text("POST", url, headers=DATABRICKS_HEADERS, data=orjson.dumps(payload))
+    if status != 200:
+        logger.error(f"Execute query endpoint returned status {status}: {text}")
         return {}
-    if not response.text.strip():
-        logger.error(f"Empty response from Genie API: {response.status_code}")
+    if not text.strip():
+        logger.error(f"Empty response from Genie API: {status}")
         return {}
     try:
-        return response.json()
+        result = _jloads(text)
     except Exception as e:
-        logger.error(f"Failed to parse JSON from Genie API: {e}, text: {response.text}")
+        logger.error(f"Failed to parse JSON from Genie API: {e}, text: {text}")
         return {}
+    # re-execution may mint a new statement; keep the cached id current
+    statement_id = ((result or {}).get("statement_response") or {}).get("statement_id")
+    if statement_id:
+        STATEMENT_IDS[(conversation_id, attachment_id)] = statement_id
+    return result
     
-def count_total_rows_via_sql_warehouse(raw_sql: str) -> Optional[int]:
+COUNT_WAIT_TIMEOUT = "20s"   # server-side wait on submit (API allows 5s-50s)
+COUNT_POLL_BUDGET_S = 60.0   # total time allowed for COUNT polling after submit
+
+async def count_total_rows_via_sql_warehouse(raw_sql: str) -> Optional[int]:
     """
     Run: SELECT COUNT(*) FROM (<raw_sql>) t
     against the Databricks SQL Statements API (warehouse).
@@ -271,10 +498,7 @@ def count_total_rows_via_sql_warehouse(raw_sql: str) -> Optional[int]:
         return None
 
     submit_url = f"{DATABRICKS_HOST}/api/2.0/sql/statements"
-    headers = {
-        "Authorization": f"Bearer {DATABRICKS_TOKEN}",
-        "Content-Type": "application/json"
-    }
+    headers = DATABRICKS_HEADERS
     stmt = f"SELECT COUNT(*) AS total_count FROM (\n{raw_sql.strip().rstrip(';')}\n) t"
     payload = {"statement": stmt, "warehouse_id": DATABRICKS_WAREHOUSE_ID}
     if DATABRICKS_CATALOG:
@@ -282,39 +506,54 @@ def count_total_rows_via_sql_warehouse(raw_sql: str) -> Optional[int]:
     if DATABRICKS_SCHEMA:
         payload["schema"] = DATABRICKS_SCHEMA
 
-    # submit
-    r = requests.post(submit_url, headers=headers, json=payload, timeout=30)
-    r.raise_for_status()
-    statement_id = (r.json() or {}).get("statement_id")
+    # submit — the API holds the request until done or wait_timeout (kept under
+    # HTTP_TIMEOUT), so fast COUNTs come back without any polling
+    payload["wait_timeout"] = COUNT_WAIT_TIMEOUT
+    payload["on_wait_timeout"] = "CONTINUE"
+    status, text = await _http_text("POST", submit_url, headers=headers, data=orjson.dumps(payload))
+    if status != 200:
+        logger.error(f"Statement submit returned status {status}: {text}")
+        return None
+    data = _jloads(text) or {}
+    statement_id = data.get("statement_id")
     if not statement_id:
         return None
 
-    # poll
+    # poll (only if still running) with capped exponential backoff
     get_url = f"{submit_url}/{statement_id}"
-    for _ in range(60):  # up to ~60s
-        g = requests.get(get_url, headers=headers, timeout=15)
-        g.raise_for_status()
-        data = g.json() or {}
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + COUNT_POLL_BUDGET_S
+    delay = 0.2
+    while True:
         state = ((data.get("status") or {}).get("state")) or ""
-        if state in ("SUCCEEDED", "FAILED", "CANCELED"):
-            if state != "SUCCEEDED":
-                return None
-            res = data.get("result") or {}
-            arr = res.get("data_array") or []
-            if arr and isinstance(arr[0], (list, tuple)) and len(arr[0]) >= 1:
-                try:
-                    return int(arr[0][0])
-                except Exception:
-                    return None
+        if state in ("SUCCEEDED", "FAILED", "CANCELED", "CLOSED"):
+            break
+        if loop.time() + delay > deadline:
             return None
-        time.sleep(1)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 2.0)
+        status, text = await _http_text("GET", get_url, headers=headers)
+        if status != 200:
+            logger.error(f"Statement poll returned status {status}: {text}")
+            return None
+        data = _jloads(text) or {}
 
+    if state != "SUCCEEDED":
+        return None
+    res = data.get("result") or {}
+    arr = res.get("data_array") or []
+    if arr and isinstance(arr[0], (list, tuple)) and len(arr[0]) >= 1:
+        try:
+            return int(arr[0][0])
+        except Exception:
+            return None
     return None
 
-def _compose_genie_prompt(user_question: str, aad_id: str | None = None) -> str:
+def _compose_genie_prompt(user_question: str, aad_id: str | None = None, prefs: dict | None = None) -> str:
     """
     Build the full Genie prompt including base instructions,
     user-specific preferences (if any), and the actual request.
+    Pass `prefs` when the caller already loaded them; otherwise they are read here.
     """
     if not GENIE_INSTRUCTIONS_ENABLED:
         return user_question
@@ -323,34 +562,291 @@ def _compose_genie_prompt(user_question: str, aad_id: str | None = None) -> str:
 
     # Inject user preferences if available
     if aad_id:
-        prefs = get_user_prefs(aad_id)
+        if prefs is None:
+            prefs = get_user_prefs(aad_id)
         system_prompt = apply_user_prefs_to_prompt(system_prompt, prefs, user_question)
 
         # ---- NEW: replace invalid mentions with valid prefs ----
-        for key, valid_values in prefs.items():
-            if key == "dept":
-                # remove any non-valid dept mentions
-                for v in re.findall(r"\b\d+\b", user_question):
-                    if v not in VALID_DEPTS:
-                        user_question = re.sub(rf"\b{re.escape(v)}\b", "", user_question)
-            elif key == "dc":
-                for v in re.findall(r"\b\d+\b", user_question):
-                    if v not in VALID_DCS:
-                        user_question = re.sub(rf"\b{re.escape(v)}\b", "", user_question)
-            elif key == "region":
-                for v in re.findall(r"\b\w+\b", user_question):
-                    if v.capitalize() not in VALID_REGIONS:
-                        user_question = re.sub(rf"\b{re.escape(v)}\b", "", user_question)
+        # one tokenizing pass: drop every token some active pref rejects
+        check_dept   = "dept" in prefs
+        check_dc     = "dc" in prefs
+        check_region = "region" in prefs
+        if check_dept or check_dc or check_region:
+            def _keep(m: re.Match) -> str:
+                tok = m.group(0)
+                if tok.isdecimal():
+                    if (check_dept and tok not in VALID_DEPTS) or (check_dc and tok not in VALID_DCS):
+                        return ""
+                if check_region and tok.capitalize() not in VALID_REGIONS:
+                    return ""
+                return tok
+
+            user_question = _TOKEN_RE.sub(_keep, user_question)
 
     return f"{system_prompt}\nREQUEST:\n{user_question}"
 
+ARROW_CSV_MIN_ROWS = 1000  # above this, let Arrow's C++ writer do the CSV
+
+# Arrow's "needed" style still quotes every string cell (and always quotes the
+# header), so the csv-module path's QUOTE_MINIMAL output is reproduced with an
+# unquoted body plus a csv-written header. A cell that does need quotes makes
+# Arrow raise ArrowInvalid, and _write_csv_gz falls back to the csv module.
+_ARROW_CSV_OPTIONS = pa_csv.WriteOptions(include_header=False, quoting_style="none")
+
+def _csv_header_line(col_names) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerow(col_names)
+    return buf.getvalue().encode("utf-8")
+
+def _write_csv_gz_arrow(path: str, col_names: list, rows: list) -> None:
+    """
+    Arrow writer for large results. Anything Arrow would render differently from
+    the csv module raises ValueError so _write_csv_gz falls back to it instead.
+    """
+    width = len(col_names)
+    if not all(len(r) == width for r in rows):
+        # zip(*rows) would silently cut every row to the shortest one
+        raise ValueError("ragged rows")
+    if width == 1 and any(r[0] is None or r[0] == "" for r in rows):
+        # csv quotes a lone empty field ("") so the line isn't blank; Arrow doesn't
+        raise ValueError("empty cell in a single-column result")
+    columns = [pa.array(list(col)) for col in zip(*rows)] if rows else [pa.array([], pa.string()) for _ in col_names]
+    if not all(pa.types.is_string(c.type) or pa.types.is_null(c.type) for c in columns):
+        # numbers/bools format differently (e.g. True vs true); keep csv's str()
+        raise ValueError("non-string column")
+    table = pa.Table.from_arrays(columns, names=list(col_names))
+    with pa.CompressedOutputStream(path, "gzip") as out:
+        out.write(_csv_header_line(col_names))
+        pa_csv.write_csv(table, out, write_options=_ARROW_CSV_OPTIONS)
+
+def _write_csv_gz(col_names: list, rows: list) -> str:
+    """
+    Write header + rows to a gzipped temp CSV (level 1: cheap, still ~5x smaller).
+    Large results go through pyarrow; anything it can't type falls back to csv.
+    """
+    tf = tempfile.NamedTemporaryFile(
+        mode="wb", delete=False, suffix=".csv.gz", dir="/tmp",
+        buffering=1 << 20,
+    )
+    if len(rows) > ARROW_CSV_MIN_ROWS:
+        tf.close()
+        try:
+            _write_csv_gz_arrow(tf.name, col_names, rows)
+            return tf.name
+        except (pa.ArrowException, ValueError, TypeError) as e:
+            logger.warning("Arrow CSV write failed (%s); falling back to csv module", e)
+            tf = open(tf.name, "wb", buffering=1 << 20)
+    try:
+        # binary temp file (1 MiB buffer) <- gzip <- explicit UTF-8 text layer
+        with gzip.open(tf, "wt", encoding="utf-8", newline="", compresslevel=1) as gz:
+            # "\n" rows, as pyarrow writes them, so both paths emit the same file
+            writer = csv.writer(gz, lineterminator="\n")
+            writer.writerow(col_names)
+            # data rows in one C-level pass
+            writer.writerows(rows)
+    finally:
+        tf.close()
+    return tf.name
+
+async def _materialize_csv(session: str, col_names: list, rows: list) -> str:
+    loop = asyncio.get_running_loop()
+    path = await loop.run_in_executor(GENIE_EXEC, _write_csv_gz, col_names, rows)
+    if CSV_TASKS.get(session) is asyncio.current_task():
+        SESSION_FILES[session] = path
+    else:
+        _unlink_quietly(path)  # a newer answer for this session superseded us
+    return path
+
+def _start_csv_task(session: str, col_names: list, rows: list) -> None:
+    """
+    Write the session CSV in the background so the reply isn't held up by it.
+    """
+    task = asyncio.ensure_future(_materialize_csv(session, col_names, rows))
+    CSV_TASKS[session] = task
+
+    def _done(t: asyncio.Task) -> None:
+        if CSV_TASKS.get(session) is t:
+            CSV_TASKS.pop(session, None)
+        if not t.cancelled() and t.exception() is not None:
+            logger.error("CSV materialization failed for session %s: %s", session, t.exception())
+
+    task.add_done_callback(_done)
+
+async def _session_csv_path(session: Optional[str]) -> Optional[str]:
+    """
+    Path of the session's CSV, waiting for a pending background write first.
+    """
+    task = CSV_TASKS.get(session)
+    if task is not None:
+        with suppress(Exception):
+            await asyncio.shield(task)
+    return SESSION_FILES.get(session)
+
+def _is_query_attachment(attachment) -> bool:
+    return bool(getattr(attachment, "attachment_id", None) and getattr(attachment, "query", None))
+
+def _attachment_raw_sql(query_obj) -> Optional[str]:
+    raw_sql = getattr(query_obj, "query", None)
+    return raw_sql.strip().rstrip(";") if raw_sql else raw_sql
+
+async def _fetch_full_attachment_result(space_id, conversation_id, message_id, attachment_id, raw_sql):
+    """
+    Re-execute the attachment's SQL and fetch the full result (used for the CSV).
+    """
+    await execute_attachment_query(
+        space_id, conversation_id, message_id, attachment_id,
+        {"query": raw_sql}
+    )
+    result = await get_attachment_query_result(
+        space_id, conversation_id, message_id, attachment_id
+    )
+    if result and CSV_MAX_CHUNKS > 1:
+        await _append_result_chunks(result)
+    return result
+
+
+CSV_MAX_CHUNKS = int(os.getenv("CSV_MAX_CHUNKS", "1"))  # 1 = first chunk only (Genie's inline rows)
+_CHUNK_FETCH_SEM = asyncio.Semaphore(4)
+
+async def _fetch_result_chunk(statement_id: str, chunk_index: int) -> list:
+    url = f"{DATABRICKS_HOST}/api/2.0/sql/statements/{statement_id}/result/chunks/{chunk_index}"
+    async with _CHUNK_FETCH_SEM:
+        status, text = await _http_text("GET", url, headers=DATABRICKS_HEADERS)
+    if status != 200:
+        raise RuntimeError(f"Result chunk {chunk_index} returned status {status}: {text}")
+    return (_jloads(text) or {}).get("data_array") or []
+
+async def _append_result_chunks(result: Dict) -> None:
+    """
+    Follow the statement's remaining result chunks (up to CSV_MAX_CHUNKS in all)
+    through the SQL Statements API and append their rows in order, in place.
+    """
+    stmt = result.get("statement_response") or {}
+    statement_id = stmt.get("statement_id")
+    total_chunks = ((stmt.get("manifest") or {}).get("total_chunk_count")) or 1
+    rows = (stmt.get("result") or {}).get("data_array")
+    if not statement_id or total_chunks <= 1 or rows is None:
+        return
+    indexes = range(1, min(total_chunks, CSV_MAX_CHUNKS))
+    try:
+        chunks = await asyncio.gather(*(_fetch_result_chunk(statement_id, i) for i in indexes))
+    except Exception as e:
+        logger.warning("Keeping first result chunk only: %s", e)
+        return
+    for chunk in chunks:
+        rows.extend(chunk)
+
+
 logger = logging.getLogger(__name__)
 
+async def _get_message_hedged(loop, space_id, conversation_id, message_id):
+    """
+    genie_api.get_message with a single hedged request: if the first call
+    hasn't returned after GENIE_HEDGE_DELAY_S, fire a second one and take
+    whichever finishes first.
+    """
+    primary = loop.run_in_executor(
+        GENIE_EXEC, genie_api.get_message, space_id, conversation_id, message_id
+    )
+    done, _ = await asyncio.wait({primary}, timeout=GENIE_HEDGE_DELAY_S)
+    if done:
+        return primary.result()
+
+    logger.debug("get_message slow after %.1fs; sending hedge request", GENIE_HEDGE_DELAY_S)
+    hedge = loop.run_in_executor(
+        GENIE_EXEC, genie_api.get_message, space_id, conversation_id, message_id
+    )
+    done, pending = await asyncio.wait({primary, hedge}, return_when=asyncio.FIRST_COMPLETED)
+    winner = done.pop()
+    if winner.exception() is not None and pending:
+        # first finisher failed; fall back to the other request
+        return await pending.pop()
+    for fut in pending:
+        fut.cancel()
+    return winner.result()
+
+async def _poll_until_complete(
+    loop, space_id, conversation_id, message_id,
+    base: float = 2, cap: float = GENIE_BACKOFF_CAP_S, budget_s: float = GENIE_POLL_BUDGET_S,
+):
+    """
+    Poll get_message until COMPLETED using capped, jittered exponential backoff.
+    Raises RuntimeError straight away on FAILED or once the wall-time budget is spent.
+    """
+    deadline = loop.time() + budget_s
+    attempt = 0
+    while True:
+        attempt += 1
+        # bound each call so a hung Genie request can't wedge the turn
+        message_content = await asyncio.wait_for(
+            _get_message_hedged(loop, space_id, conversation_id, message_id),
+            timeout=GENIE_CALL_TIMEOUT_S,
+        )
+        status = getattr(message_content, "status", None)
+        logger.debug("[Poll %d] status=%s", attempt, status)
+
+        if status == MessageStatus.COMPLETED:
+            return message_content
+        if status == MessageStatus.FAILED:
+            err = getattr(message_content, "error_message", "<no error>")
+            logger.error(f"Genie FAILED on attempt {attempt}: {err}")
+            raise RuntimeError(f"Genie FAILED: {err}")
+
+        # "equal jitter": half the capped delay fixed, half random
+        delay = min(cap, base ** attempt) * (0.5 + random.random() * 0.5)
+        if loop.time() + delay >= deadline:
+            raise RuntimeError(f"Genie did not complete after {attempt} attempts")
+        logger.debug("Sleeping %.1fs before retry", delay)
+        await asyncio.sleep(delay)
+
 async def ask_genie(
     question: str,
     space_id: str,
     conversation_id: Optional[str] = None,
-    aad_id: Optional[str] = None
+    aad_id: Optional[str] = None,
+    prefs: Optional[dict] = None,
+) -> tuple[str, str]:
+    """
+    Front door for `_ask_genie`. Concurrent duplicates (same space, conversation,
+    user and composed prompt, so the same prefs) share a single in-flight call.
+    `prefs` are the user's already-loaded preferences, if the caller has them.
+    """
+    # Compose prompt with per-turn instructions
+    composed_question = _compose_genie_prompt(question, aad_id, prefs)
+    key = (space_id, conversation_id, aad_id, composed_question)
+
+    fut = GENIE_INFLIGHT.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_ask_genie_in_turn(composed_question, space_id, conversation_id))
+        GENIE_INFLIGHT[key] = fut
+        fut.add_done_callback(lambda f, key=key: GENIE_INFLIGHT.pop(key, None))
+    else:
+        logger.info("Joining in-flight Genie call for conversation %s", conversation_id)
+
+    # shield: one caller giving up (e.g. turn cancelled) must not cancel the shared call
+    return await asyncio.shield(fut)
+
+async def _ask_genie_in_turn(composed_question, space_id, conversation_id):
+    """
+    Queue follow-ups behind the conversation's in-flight turn so Genie sees them
+    in order (it handles one message per conversation at a time). The GENIE_SEM
+    slot is taken inside the conversation lock, so a queued follow-up waits
+    without holding a slot other conversations could use.
+    """
+    if conversation_id is None:
+        async with GENIE_SEM:
+            return await _ask_genie(composed_question, space_id, conversation_id)
+    lock = _CONVERSATION_LOCKS.get(conversation_id)
+    if lock is None:
+        lock = _CONVERSATION_LOCKS[conversation_id] = asyncio.Lock()
+    async with lock:
+        async with GENIE_SEM:
+            return await _ask_genie(composed_question, space_id, conversation_id)
+
+async def _ask_genie(
+    composed_question: str,
+    space_id: str,
+    conversation_id: Optional[str] = None,
 ) -> tuple[str, str]:
     logger.debug("🔥 ENTERING ask_genie v2! 🔥")
     logger.debug("🛠️  ASK_GENIE PAYLOAD HOTFIX DEPLOYED 🛠️")
@@ -360,17 +856,14 @@ async def ask_genie(
         # ───────────────────────────────────────────────────────────────────────────
         # 1) start or continue conversation
         # ───────────────────────────────────────────────────────────────────────────
-        # Compose prompt with per-turn instructions
-        composed_question = _compose_genie_prompt(question, aad_id)
-
         if conversation_id is None:
             initial_message = await loop.run_in_executor(
-                None, genie_api.start_conversation_and_wait, space_id, composed_question
+                GENIE_EXEC, genie_api.start_conversation_and_wait, space_id, composed_question
             )
             conversation_id = initial_message.conversation_id
         else:
             initial_message = await loop.run_in_executor(
-                None,
+                GENIE_EXEC,
                 genie_api.create_message_and_wait,
                 space_id, conversation_id, composed_question
             )
@@ -378,205 +871,161 @@ async def ask_genie(
         message_id = initial_message.message_id
 
         # ───────────────────────────────────────────────────────────────────────────
-        # 2) poll for COMPLETED with exponential backoff
+        # 2) *_and_wait already blocks until a terminal state; only poll if it didn't
         # ───────────────────────────────────────────────────────────────────────────
-        max_attempts = 5
-        backoff_base = 2
-        for attempt in range(1, max_attempts + 1):
-            message_content = await loop.run_in_executor(
-                None,
-                genie_api.get_message,
-                space_id, conversation_id, message_id
-            )
-            status = getattr(message_content, "status", None)
-            logger.debug(f"[Poll {attempt}/{max_attempts}] status={status}")
-
-            if status == MessageStatus.COMPLETED:
-                break
-            if status == MessageStatus.FAILED:
-                err = getattr(message_content, "error_message", "<no error>")
-                logger.error(f"Genie FAILED on attempt {attempt}: {err}")
-            else:
-                logger.debug(f"Sleeping {backoff_base**attempt}s before retry")
-
-            if attempt < max_attempts:
-                time.sleep(backoff_base ** attempt)
-            else:
-                raise RuntimeError(f"Genie did not complete after {max_attempts} attempts")
+        if initial_message.status == MessageStatus.COMPLETED and initial_message.attachments is not None:
+            message_content = initial_message
+        elif initial_message.status == MessageStatus.FAILED:
+            err = getattr(initial_message, "error", None) or "<no error>"
+            raise RuntimeError(f"Genie FAILED: {err}")
+        else:
+            message_content = await _poll_until_complete(loop, space_id, conversation_id, message_id)
 
-        logger.info(f"Raw message content: {message_content}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Raw message content: %s", message_content)
 
         # ───────────────────────────────────────────────────────────────────────────
         # 3) handle any plain‑text attachments first
         # ───────────────────────────────────────────────────────────────────────────
         if message_content.attachments:
-            for attachment in message_content.attachments:
+            attachments = message_content.attachments
 
-                # 3a) Plain‑text cards first
+            # 3a) Plain‑text cards first (short-circuit before any SQL fetches)
+            for attachment in attachments:
                 text_obj = getattr(attachment, "text", None)
                 if text_obj and hasattr(text_obj, "content"):
-                    return json.dumps({"message": text_obj.content}), conversation_id
-
-                # 3b) SQL cards next
-                attachment_id = getattr(attachment, "attachment_id", None)
-                query_obj     = getattr(attachment, "query", None)
-                if attachment_id and query_obj:
-                    # — pull description & raw SQL —
-                    desc    = getattr(query_obj, "description", None) or ""
-                    raw_sql = getattr(query_obj, "query",      None)
-
-                    if raw_sql:
-                        raw_sql = raw_sql.strip().rstrip(";")
-                        raw_sql_limited = f"{raw_sql} LIMIT {MAX_ROWS + 1}"  # ask for one extra row
-                    else:
-                        raw_sql_limited = raw_sql
-
-                    # ───────────────────────────────────────────────────────
-                    # A) FULL result (for CSV) — re-execute raw_sql, then fetch
-                    # ───────────────────────────────────────────────────────
-                    await loop.run_in_executor(
-                        None,
-                        execute_attachment_query,
-                        space_id, conversation_id, message_id, attachment_id,
-                        {"query": raw_sql}
-                    )
-                    full_result = await loop.run_in_executor(
-                        None,
-                        get_attachment_query_result,
-                        space_id,
-                        conversation_id,
-                        message_id,
-                        attachment_id
-                    )
-                    full_stmt    = (full_result or {}).get("statement_response", {}) or {}
-                    full_rows    = ((full_stmt.get("result") or {}).get("data_array") or [])
-                    full_schema  = ((full_stmt.get("manifest") or {}).get("schema") or {}).get("columns", []) or []
-                    csv_rows     = len(full_rows)
-
-                    # Authoritative total via SQL Warehouse (independent of Genie)
-                    db_total_rows = await loop.run_in_executor(
-                        None,
-                        count_total_rows_via_sql_warehouse,
-                        raw_sql
-                    )
-
-                    # 3) write them to a temp CSV file
-                    tf = tempfile.NamedTemporaryFile(
-                        mode="w", newline="", delete=False, suffix=".csv", dir="/tmp"
+                    return _jdumps({"message": text_obj.content}), conversation_id
+                if _is_query_attachment(attachment):
+                    break
+
+            # 3b) SQL cards next — the reply renders only the first attachment that
+            #     fetches cleanly, and each fetch re-runs its SQL on the warehouse,
+            #     so fetch them in order and stop at the first success.
+            query_attachments = [a for a in attachments if _is_query_attachment(a)]
+
+            for attachment in query_attachments:
+                # The warehouse COUNT only needs the SQL; let it overlap the fetch.
+                count_task = asyncio.ensure_future(
+                    count_total_rows_via_sql_warehouse(_attachment_raw_sql(attachment.query))
+                )
+                try:
+                    full_result = await _fetch_full_attachment_result(
+                        space_id, conversation_id, message_id, attachment.attachment_id,
+                        _attachment_raw_sql(attachment.query)
                     )
-                    writer = csv.writer(tf)
-                    # header row
-                    writer.writerow([col["name"] for col in full_schema])
-                    # data rows
-                    for row in full_rows:
-                        writer.writerow(row)
-                    tf.close()
-
-                    # 4) record the file path for this session
-                    SESSION_FILES[conversation_id] = tf.name
-
-                    # ──────────────────────────────────────────────────────────
-                    # 4) LIMITED preview for Teams — execute limited SQL, fetch, compute sizes
-                    # ──────────────────────────────────────────────────────────
-                    try:
-                        # Re-execute the limited SQL on this attachment
-                        await loop.run_in_executor(
-                        None,
-                        execute_attachment_query,
-                        space_id, conversation_id, message_id, attachment_id,
-                        {"query": raw_sql}
-                        )
-
-                        # Fetch the limited result
-                        query_result = await loop.run_in_executor(
-                            None,
-                            get_attachment_query_result,
-                            space_id, conversation_id, message_id, attachment_id,
-                        )
-
-                        # Normalize & enforce MAX_ROWS defensively
-                        rows = query_result["statement_response"]["result"].get("data_array", []) or []
-                        if len(rows) > MAX_ROWS:
-                            rows = rows[:MAX_ROWS]
-                            query_result["statement_response"]["result"]["data_array"] = rows
-
-                        shown_rows = len(rows)
-
-                        # Derive counts (handle missing COUNT by falling back to csv_rows)
-                        if db_total_rows is None:
-                            db_total_rows = csv_rows
-
-                        teams_truncated = max(csv_rows - shown_rows, 0)       # CSV → Teams
-                        csv_truncated   = max(db_total_rows - csv_rows, 0)    # DB → CSV (Genie cap)
-                        total_truncated = max(db_total_rows - shown_rows, 0)  # DB → Teams
-                        truncated       = total_truncated > 0
-
-                    except Exception as e:
-                        logger.warning(f"Genie error or payload too large: {e}")
-                        shown_rows = 0
-                        if db_total_rows is None:
-                            db_total_rows = 0
-                        csv_rows = 0
-                        teams_truncated = 0
-                        csv_truncated   = max(db_total_rows - csv_rows, 0)
-                        total_truncated = max(db_total_rows - shown_rows, 0)
-                        truncated       = total_truncated > 0
-                        query_result = {
-                            "query_result_metadata": {},
-                            "statement_response": {
-                                "result": {"data_array": []},
-                                "manifest": {"schema": {"columns": []}}
-                            }
+                except Exception as e:
+                    count_task.cancel()
+                    logger.warning(f"Attachment {attachment.attachment_id} fetch failed: {e}")
+                    continue
+
+                attachment_id = attachment.attachment_id
+                query_obj     = attachment.query
+
+                # — pull description & raw SQL —
+                desc    = getattr(query_obj, "description", None) or ""
+                raw_sql = _attachment_raw_sql(query_obj)
+
+                # ───────────────────────────────────────────────────────
+                # A) FULL result (for CSV) — already fetched above
+                # ───────────────────────────────────────────────────────
+                full_stmt    = (full_result or {}).get("statement_response", {}) or {}
+                full_rows    = ((full_stmt.get("result") or {}).get("data_array") or [])
+                full_schema  = ((full_stmt.get("manifest") or {}).get("schema") or {}).get("columns", []) or []
+                csv_rows     = len(full_rows)
+
+                # Authoritative total via SQL Warehouse (independent of Genie)
+                try:
+                    db_total_rows = await count_task
+                except Exception as e:
+                    logger.warning(f"Warehouse COUNT failed: {e}")
+                    db_total_rows = None
+
+                # 3) write the CSV in the background; /download_csv waits for it
+                _start_csv_task(conversation_id, [col["name"] for col in full_schema], full_rows)
+
+                # ──────────────────────────────────────────────────────────
+                # 4) LIMITED preview for Teams — slice the full result, compute sizes
+                # ──────────────────────────────────────────────────────────
+                rows = full_rows[:MAX_ROWS]
+                shown_rows = len(rows)
+                if full_stmt.get("result") is not None:
+                    # copy on the way down so full_result keeps every row
+                    query_result = {
+                        "query_result_metadata": full_result.get("query_result_metadata", {}),
+                        "statement_response": {**full_stmt, "result": {**full_stmt["result"], "data_array": rows}},
+                    }
+                else:
+                    logger.warning("Genie returned no result for attachment %s", attachment_id)
+                    query_result = {
+                        "query_result_metadata": {},
+                        "statement_response": {
+                            "result": {"data_array": []},
+                            "manifest": {"schema": {"columns": []}}
                         }
-
-                    if db_total_rows is None or db_total_rows < csv_rows:
-                        logger.warning("Warehouse COUNT < CSV rows, correcting total to CSV size")
-                        db_total_rows = csv_rows
-
-                    logger.debug(f"🔍 query_result after truncate/error: {query_result!r}")
-
-                    # Build the answer JSON dict
-                    answer_json = {
-                        "query_description": desc or "",
-                        "query_result_metadata": query_result.get("query_result_metadata", {}),
-                        "statement_response":    query_result.get("statement_response", {}),
-                        "raw_sql":               raw_sql or "",
-                        "raw_sql_executed":      raw_sql_limited or "",
-                        "truncated":             truncated,
-
-                        # NEW: sizes
-                        "db_total_rows":   int(db_total_rows or 0),  # true total
-                        "csv_rows":        int(csv_rows or 0),       # rows in downloadable CSV
-                        "shown_rows":      int(shown_rows or 0),     # rows in Teams
-
-                        # NEW: breakdown
-                        "teams_truncated": int(teams_truncated or 0),  # csv_rows - shown_rows
-                        "csv_truncated":   int(csv_truncated or 0),    # db_total_rows - csv_rows
-                        "total_truncated": int(total_truncated or 0),  # db_total_rows - shown_rows
                     }
-                    # Store for Dash to fetch later
+
+                # Derive counts (handle missing COUNT by falling back to csv_rows)
+                if db_total_rows is None:
+                    db_total_rows = csv_rows
+
+                teams_truncated = max(csv_rows - shown_rows, 0)       # CSV → Teams
+                csv_truncated   = max(db_total_rows - csv_rows, 0)    # DB → CSV (Genie cap)
+                total_truncated = max(db_total_rows - shown_rows, 0)  # DB → Teams
+                truncated       = total_truncated > 0
+
+                if db_total_rows is None or db_total_rows < csv_rows:
+                    logger.warning("Warehouse COUNT < CSV rows, correcting total to CSV size")
+                    db_total_rows = csv_rows
+
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("🔍 query_result after truncate/error: %r", query_result)
+
+                # Build the answer JSON dict
+                answer_json = {
+                    "query_description": desc or "",
+                    "query_result_metadata": query_result.get("query_result_metadata", {}),
+                    "statement_response":    query_result.get("statement_response", {}),
+                    "raw_sql":               raw_sql or "",
+                    "raw_sql_executed":      raw_sql or "",  # the one statement actually run
+                    "truncated":             truncated,
+
+                    # NEW: sizes
+                    "db_total_rows":   int(db_total_rows or 0),  # true total
+                    "csv_rows":        int(csv_rows or 0),       # rows in downloadable CSV
+                    "shown_rows":      int(shown_rows or 0),     # rows in Teams
+
+                    # NEW: breakdown
+                    "teams_truncated": int(teams_truncated or 0),  # csv_rows - shown_rows
+                    "csv_truncated":   int(csv_truncated or 0),    # db_total_rows - csv_rows
+                    "total_truncated": int(total_truncated or 0),  # db_total_rows - shown_rows
+                }
+                # Store for Dash to fetch later
+                if logger.isEnabledFor(logging.DEBUG):
                     logger.debug("🚀 FINAL GENIE PAYLOAD: %r", answer_json)
-                    SESSION_DATA[conversation_id] = answer_json
+                SESSION_DATA[conversation_id] = answer_json
 
-                    logger.info(
-                        "Sizes: db_total=%s csv=%s shown=%s | truncated total=%s (csv=%s, teams=%s)",
-                        answer_json["db_total_rows"], answer_json["csv_rows"], answer_json["shown_rows"],
-                        answer_json["total_truncated"], answer_json["csv_truncated"], answer_json["teams_truncated"]
-                    )
-                    
-                    return json.dumps(answer_json), conversation_id
+                logger.info(
+                    "Sizes: db_total=%s csv=%s shown=%s | truncated total=%s (csv=%s, teams=%s)",
+                    answer_json["db_total_rows"], answer_json["csv_rows"], answer_json["shown_rows"],
+                    answer_json["total_truncated"], answer_json["csv_truncated"], answer_json["teams_truncated"]
+                )
+                
+                return _jdumps(answer_json), conversation_id
 
         # ────────────────
         # Fallback if no attachments at all
         # ────────────────
-        return json.dumps({"error": "No data available."}), conversation_id
+        return _jdumps({"error": "No data available."}), conversation_id
 
     except Exception as e:
         logger.error(f"Error in ask_genie: {e}", exc_info=True)
-        return json.dumps({"error": "An error occurred while processing your request."}), conversation_id
+        return _jdumps({"error": "An error occurred while processing your request."}), conversation_id
 
 SUBJECT_PREFIX = "Five Below - "
 SUBJECT_MAX = 72  # keep it inbox-friendly
+_SUBJ_STOP  = re.compile(r"\b(this|a|an|the|of|for|to|that|which)\b", re.I)
+_SUBJ_WS    = re.compile(r"\s+")
+_SUBJ_STRIP = str.maketrans("", "", "\"'[]")
 
 def build_business_subject(answer_json: Dict) -> str:
     desc = (answer_json.get("query_description") or "").strip()
@@ -584,10 +1033,10 @@ def build_business_subject(answer_json: Dict) -> str:
         return SUBJECT_PREFIX + "Results Summary"
 
     # trim boilerplate words
-    desc = re.sub(r"\b(this|a|an|the|of|for|to|that|which)\b", "", desc, flags=re.I)
-    desc = re.sub(r"\s+", " ", desc).strip(" -—:.,")
+    desc = _SUBJ_STOP.sub("", desc)
+    desc = _SUBJ_WS.sub(" ", desc).strip(" -—:.,")
     # kill quotes/brackets that clutter subjects
-    desc = desc.replace('"', '').replace("'", "").replace("[", "").replace("]", "")
+    desc = desc.translate(_SUBJ_STRIP)
     subj = SUBJECT_PREFIX + desc
 
     # nicely truncate on word boundary
@@ -596,6 +1045,47 @@ def build_business_subject(answer_json: Dict) -> str:
         subj = cut + "…"
     return subj
 
+_EMAIL_FLOAT_TYPES = frozenset({"DECIMAL", "DOUBLE", "FLOAT", "REAL", "NUMERIC"})
+_EMAIL_INT_TYPES   = frozenset({"INT", "INTEGER", "BIGINT", "SMALLINT", "TINYINT", "LONG"})
+# Preview-table markup; rows are "<tr><td>" + "</td><td>".join(cells) + "</td></tr>"
+_EMAIL_TD_OPEN = '<td style="border:1px solid #ddd;padding:6px">'
+_EMAIL_TD_CLOSE = "</td>"
+_EMAIL_ROW_OPEN = "<tr>" + _EMAIL_TD_OPEN
+_EMAIL_CELL_SEP = _EMAIL_TD_CLOSE + _EMAIL_TD_OPEN
+_EMAIL_ROW_CLOSE = _EMAIL_TD_CLOSE + "</tr>"
+
+def _email_fmt_float(val) -> str:
+    if val is None:
+        return "NULL"
+    try:
+        return f"{float(val):,.2f}"
+    except Exception:
+        return str(val)  # fall back to str if conversion fails
+
+def _email_fmt_int(val) -> str:
+    if val is None:
+        return "NULL"
+    try:
+        return f"{int(float(val)):,.0f}"
+    except Exception:
+        return str(val)
+
+def _email_fmt_str(val) -> str:
+    return "NULL" if val is None else str(val)
+
+def _email_cell_formatter(type_name: Optional[str]) -> Callable[[object], str]:
+    t = (type_name or "").upper()
+    if t in _EMAIL_FLOAT_TYPES:
+        return _email_fmt_float
+    if t in _EMAIL_INT_TYPES:
+        return _email_fmt_int
+    return _email_fmt_str
+
+_EMAIL_ESC_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+def _email_esc(s: str) -> str:
+    return (s or "").translate(_EMAIL_ESC_TABLE)  # one pass instead of three replaces
+
 def build_email_bodies(answer_json: Dict, preview_max: int = PREVIEW_MAX_ROWS) -> tuple[str, str, bool]:
     """
     Build both PLAINTEXT and HTML versions of the email body from the Genie `answer_json`.
@@ -625,31 +1115,24 @@ def build_email_bodies(answer_json: Dict, preview_max: int = PREVIEW_MAX_ROWS) -
 
     include_preview = db_total_rows <= preview_max
 
-    def fmt_cell(val, col_type_name: str | None) -> str:
-        if val is None:
-            return "NULL"
-        t = (col_type_name or "").upper()
-        try:
-            if t in ("DECIMAL", "DOUBLE", "FLOAT", "REAL", "NUMERIC"):
-                return f"{float(val):,.2f}"
-            if t in ("INT", "INTEGER", "BIGINT", "SMALLINT", "TINYINT", "LONG"):
-                return f"{int(float(val)):,.0f}"
-        except Exception:
-            # fall through to str if conversion fails
-            pass
-        return str(val)
+    # one formatter per column, picked once
+    col_fmts = [_email_cell_formatter(c.get("type_name")) for c in schema]
+
+    def fmt_row(r) -> list:
+        return [fmt(v) for fmt, v in zip(col_fmts, r)]
 
     # ----------------- PLAINTEXT -----------------
-    lines = []
-    lines.append("")
-    lines.append("")
-    lines.append("")
-    lines.append("Results Summary")
-    lines.append("")
-    lines.append(f"Description: {desc}")
-    lines.append(f"Total rows in dataset: {db_total_rows:,}")
-    lines.append(f"Rows shown in Teams: {shown_rows:,}")
-    lines.append(f"Rows in CSV: {csv_rows:,}")
+    lines = [
+        "",
+        "",
+        "",
+        "Results Summary",
+        "",
+        f"Description: {desc}",
+        f"Total rows in dataset: {db_total_rows:,}",
+        f"Rows shown in Teams: {shown_rows:,}",
+        f"Rows in CSV: {csv_rows:,}",
+    ]
     if teams_truncated:
         lines.append(f"Teams view truncated: {teams_truncated:,}")
     if csv_truncated:
@@ -660,14 +1143,8 @@ def build_email_bodies(answer_json: Dict, preview_max: int = PREVIEW_MAX_ROWS) -
         # Optional: add a tiny plaintext preview header and first few lines
         # (kept minimal since HTML carries the full 50-row preview)
         header_txt = " | ".join(col_names)
-        lines.append("")
-        lines.append(header_txt)
-        lines.append("-" * len(header_txt))
-        for r in rows[:min(len(rows), preview_max, 5)]:
-            formatted = []
-            for v, c in zip(r, schema):
-                formatted.append(fmt_cell(v, c.get("type_name")))
-            lines.append(" | ".join(formatted))
+        lines += ("", header_txt, "-" * len(header_txt))
+        lines.extend(" | ".join(fmt_row(r)) for r in rows[:min(len(rows), preview_max, 5)])
     else:
         lines.append("")
         lines.append(f"Preview omitted due to size (> {preview_max} rows). CSV attached.")
@@ -675,9 +1152,8 @@ def build_email_bodies(answer_json: Dict, preview_max: int = PREVIEW_MAX_ROWS) -
     plain_body = "\n".join(lines).strip("\n")
 
     # ------------------- HTML --------------------
-    def esc(s: str) -> str:
-        return (s or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-    
+    esc = _email_esc
+
     html_parts = [
         '<p style="margin:0 0 12px 0;">&nbsp;</p>',
         '<p style="margin:0 0 12px 0;">&nbsp;</p>',
@@ -701,18 +1177,17 @@ def build_email_bodies(answer_json: Dict, preview_max: int = PREVIEW_MAX_ROWS) -
             f'<th style="border:1px solid #ddd;padding:6px;background:#f5f5f5;text-align:left">{esc(c)}</th>'
             for c in col_names
         )
-        body_rows = []
-        for r in rows[:preview_max]:
-            cells = []
-            for v, c in zip(r, schema):
-                cells.append(esc(fmt_cell(v, c.get("type_name"))))
-            tds = "".join(f'<td style="border:1px solid #ddd;padding:6px">{cell}</td>' for cell in cells)
-            body_rows.append(f"<tr>{tds}</tr>")
-        table_html = (
+        html_parts.append(
             '<table cellspacing="0" cellpadding="0" style="border-collapse:collapse;border:1px solid #ddd;margin-top:8px">'
-            f"<thead><tr>{thead}</tr></thead><tbody>{''.join(body_rows)}</tbody></table>"
+            f"<thead><tr>{thead}</tr></thead><tbody>"
         )
-        html_parts.append(table_html)
+        append = html_parts.append
+        sep_join = _EMAIL_CELL_SEP.join
+        for r in rows[:preview_max]:
+            append(_EMAIL_ROW_OPEN)
+            append(sep_join(map(esc, fmt_row(r))))
+            append(_EMAIL_ROW_CLOSE)
+        append("</tbody></table>")
     else:
         html_parts.append(f'<p><em>Preview omitted due to size (&gt; {preview_max} rows). CSV attached.</em></p>')
 
@@ -733,45 +1208,87 @@ def _oauth_authorize_url(state: str) -> str:
     }
     return f"https://login.microsoftonline.com/{MS_TENANT_ID}/oauth2/v2.0/authorize?{urlencode(params)}"
 
-def _oauth_token_request(data: Dict[str, str]) -> Dict:
+async def _oauth_token_request(data: Dict[str, str]) -> Dict:
     url = f"https://login.microsoftonline.com/{MS_TENANT_ID}/oauth2/v2.0/token"
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
-    r = requests.post(url, headers=headers, data=data, timeout=30)
-    r.raise_for_status()
-    return r.json()
+    status, text = await _http_text("POST", url, headers=headers, data=data)
+    if status != 200:
+        raise RuntimeError(f"Token endpoint returned {status}: {text[:300]}")
+    return _jloads(text)
 
 def _now_epoch() -> int:
     return int(time.time())
 
 def _save_tokens_for_user(user_id: str, tok: Dict):
-    GRAPH_TOKENS[user_id] = {
-        "access_token": tok["access_token"],
-        "refresh_token": tok.get("refresh_token", ""),
-        "expires_at": str(_now_epoch() + int(tok.get("expires_in", 3600) - 60)),
-    }
+    GRAPH_TOKENS[user_id] = TokenInfo(
+        access_token=tok["access_token"],
+        refresh_token=tok.get("refresh_token", ""),
+        expires_at=_now_epoch() + int(tok.get("expires_in", 3600) - 60),
+    )
+
+# Tokens are refreshed in the background ahead of expiry so replies rarely
+# wait on login.microsoftonline.com; the inline refresh is only a fallback.
+GRAPH_REFRESH_INTERVAL = 60   # seconds between background sweeps
+GRAPH_REFRESH_AHEAD = 300     # refresh tokens expiring within this window
+_GRAPH_REFRESHING: Dict[str, asyncio.Task] = {}
 
-def _get_valid_access_token(user_id: str) -> Optional[str]:
+async def _refresh_tokens_for_user(user_id: str, refresh_token: str) -> Dict:
+    tok = await _oauth_token_request({
+        "client_id": MS_CLIENT_ID,
+        "scope": MS_SCOPES,
+        "refresh_token": refresh_token,
+        "grant_type": "refresh_token",
+        "client_secret": MS_CLIENT_SECRET,
+        "redirect_uri": MS_REDIRECT_URI,
+    })
+    _save_tokens_for_user(user_id, tok)
+    return tok
+
+def _start_token_refresh(user_id: str, refresh_token: str) -> asyncio.Task:
+    """One refresh per user at a time, shared by the sweeper and inline callers."""
+    task = _GRAPH_REFRESHING.get(user_id)
+    if task is None:
+        task = asyncio.ensure_future(_refresh_tokens_for_user(user_id, refresh_token))
+        _GRAPH_REFRESHING[user_id] = task
+        task.add_done_callback(lambda _t: _GRAPH_REFRESHING.pop(user_id, None))
+    return task
+
+async def _get_valid_access_token(user_id: str) -> Optional[str]:
     info = GRAPH_TOKENS.get(user_id)
     if not info:
         return None
-    if _now_epoch() < int(info.get("expires_at", "0")) and info.get("access_token"):
-        return info["access_token"]
-    if info.get("refresh_token"):
+    if _now_epoch() < info.expires_at and info.access_token:
+        return info.access_token
+    if info.refresh_token:
         try:
-            tok = _oauth_token_request({
-                "client_id": MS_CLIENT_ID,
-                "scope": MS_SCOPES,
-                "refresh_token": info["refresh_token"],
-                "grant_type": "refresh_token",
-                "client_secret": MS_CLIENT_SECRET,
-                "redirect_uri": MS_REDIRECT_URI,
-            })
-            _save_tokens_for_user(user_id, tok)
+            tok = await asyncio.shield(_start_token_refresh(user_id, info.refresh_token))
             return tok["access_token"]
         except Exception:
             logger.exception("Graph token refresh failed")
     return None
 
+async def _graph_token_refresher():
+    while True:
+        await asyncio.sleep(GRAPH_REFRESH_INTERVAL)
+        cutoff = _now_epoch() + GRAPH_REFRESH_AHEAD
+        for user_id, info in list(GRAPH_TOKENS.items()):
+            if info.refresh_token and info.expires_at < cutoff:
+                task = _start_token_refresh(user_id, info.refresh_token)
+                task.add_done_callback(_log_refresh_failure)
+
+def _log_refresh_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Background Graph token refresh failed: %s", task.exception())
+
+async def _start_graph_refresher(app: web.Application):
+    app["graph_refresher"] = asyncio.create_task(_graph_token_refresher())
+
+async def _stop_graph_refresher(app: web.Application):
+    app["graph_refresher"].cancel()
+
+app.on_startup.append(_start_graph_refresher)
+app.on_cleanup.append(_stop_graph_refresher)
+
 KEY_NORMALIZATION = {
     "department": "dept",
     "departments": "dept",
@@ -784,35 +1301,54 @@ KEY_NORMALIZATION = {
     "regions": "region",
 }
 
+# Preference command / extraction patterns, compiled once at import
+_PREF_CONNECTOR = r"(?:are|is|=|as|to|:)?"
+PREF_PATTERNS = {
+    # dept / departments …
+    "dept": re.compile(
+        rf"\b(?:dept|depts|department|departments)\s*{_PREF_CONNECTOR}\s*([\d\s, and]+)",
+        re.IGNORECASE,
+    ),
+    # dc / dcs / distribution center(s)
+    "dc": re.compile(
+        rf"\b(?:dc|dcs|distribution\s+center(?:s)?)\s*{_PREF_CONNECTOR}\s*([\d\s, and]+)",
+        re.IGNORECASE,
+    ),
+    # region(s) – words allowed
+    "region": re.compile(
+        rf"\bregion(?:s)?\s*{_PREF_CONNECTOR}\s*([\w\s, and]+)",
+        re.IGNORECASE,
+    ),
+}
+_PREF_SPLIT_RE = re.compile(r"\s*(?:,|and)\s*")
+# Single-pass gate over every preference keyword; most questions mention none
+_PREF_KEYWORD_RE = re.compile(
+    r"\b(?:dept|depts|department|departments|dcs?|distribution\s+center|region)",
+    re.IGNORECASE,
+)
+
+_DEPT_COMBO_RE = re.compile(r"\b(?:dept|depts|department|departments)\s*(.+)", re.I)
+_DEPT_SPLIT_RE = re.compile(r"[,\s]+and\s+|,|\s+and\s+")
+# dept / dc / region mentions in one scan. Each alternative sits in a
+# lookahead so matches of different keys may overlap, exactly as three
+# separate findall() calls would allow.
+_ALL_PREFS_RE = re.compile(
+    r"(?=\b(?:dept|depts|department|departments)\s*(?:=)?\s*(?P<dept>\d+)"
+    r"|\b(?:dc|distribution center)\s*(?P<dc>\d+)"
+    r"|\bregion(?:s)?\s*(?:=)?\s*(?P<region>[a-zA-Z\s]+))",
+    re.I,
+)
+
 async def maybe_handle_pref_command(turn_context, aad_id: str, question: str) -> bool:
     """
     Handle explicit commands like 'remember my dept is 42'
     or 'set dc 3 and 7'.
     Returns True if handled, False otherwise.
     """
-    text = question.lower()
-
-    CONNECTOR = r"(?:are|is|=|as|to|:)?"   # <-- add as|to|: here
-
-    patterns = {
-        # dept / departments …
-        "dept": re.compile(
-            rf"\b(?:dept|depts|department|departments)\s*{CONNECTOR}\s*([\d\s, and]+)",
-            re.IGNORECASE,
-        ),
-        # dc / dcs / distribution center(s)
-        "dc": re.compile(
-            rf"\b(?:dc|dcs|distribution\s+center(?:s)?)\s*{CONNECTOR}\s*([\d\s, and]+)",
-            re.IGNORECASE,
-        ),
-        # region(s) – words allowed
-        "region": re.compile(
-            rf"\bregion(?:s)?\s*{CONNECTOR}\s*([\w\s, and]+)",
-            re.IGNORECASE,
-        ),
-    }
+    if not _PREF_KEYWORD_RE.search(question):
+        return False
 
-    for key, pattern in patterns.items():
+    for key, pattern in PREF_PATTERNS.items():
         match = pattern.search(question)
         if match:
             key = KEY_NORMALIZATION.get(key, key)
@@ -821,11 +1357,11 @@ async def maybe_handle_pref_command(turn_context, aad_id: str, question: str) ->
             # Split multiple values on commas or "and"
             if key in ("dept", "dc"):
                 # numeric lists (comma or "and")
-                values = re.split(r"\s*(?:,|and)\s*", raw_value)
+                values = _PREF_SPLIT_RE.split(raw_value)
                 values = [v.strip() for v in values if v.strip().isdigit()]
             else:  # region
                 # region names: allow multi-word tokens like "great lakes"
-                values = re.split(r"\s*(?:,|and)\s*", raw_value)
+                values = _PREF_SPLIT_RE.split(raw_value)
                 values = [v.strip().upper() for v in values if v.strip()]
 
             if not values:
@@ -836,7 +1372,7 @@ async def maybe_handle_pref_command(turn_context, aad_id: str, question: str) ->
             if not valid:
                 await turn_context.send_activity(
                     f"⚠️ Sorry, I can’t save {key}={', '.join(invalid)}. "
-                    f"Valid values are: {', '.join(sorted(VALID_DCS if key=='dc' else VALID_DEPTS if key=='dept' else VALID_REGIONS))}."
+                    f"Valid values are: {VALID_SORTED_STR.get(key, VALID_REGIONS_SORTED_STR)}."
                 )
                 return True  # handled; don’t call Genie
 
@@ -873,38 +1409,39 @@ async def maybe_handle_pref_command(turn_context, aad_id: str, question: str) ->
 
     return False
 
+# What a clear command targets. Keys are listed in priority order (a message
+# naming both "dept" and "all" clears only dept); values are
+# (storage key or None for everything, log label, confirmation).
+_CLEAR_TARGET_RE = re.compile(
+    r"\b(?P<dept>dept|department)"
+    r"|\b(?P<dc>dc|distribution\s+center)"
+    r"|\b(?P<region>region)"
+    r"|\b(?P<all>all|prefs|preferences)\b",
+    re.IGNORECASE,
+)
+_CLEAR_TARGETS = {
+    "dept":   ("dept", "dept", "🗑️ Cleared your saved department preference(s)."),
+    "dc":     ("dc", "dc", "🗑️ Cleared your saved distribution center preference(s)."),
+    "region": ("region", "region", "🗑️ Cleared your saved region preference(s)."),
+    "all":    (None, "all", "🗑️ All saved preferences have been reset."),
+}
+
 async def maybe_handle_clear_command(turn_context, aad_id: str, question: str) -> bool:
     """
     Handle explicit commands like 'clear my dept', 'forget region', 'reset all'.
     Returns True if handled, False otherwise.
     """
-    if not CLEAR_INTENT.search(question):
+    if not has_clear_intent(question):
         return False
 
-    text = question.lower()
-    prefs = None
-    cleared_key = None
-    message = ""
-
-    if "dept" in text or "department" in text:
-        prefs = clear_user_pref(aad_id, "dept")
-        cleared_key = "dept"
-        message = "🗑️ Cleared your saved department preference(s)."
-    elif "dc" in text or "distribution center" in text:
-        prefs = clear_user_pref(aad_id, "dc")
-        cleared_key = "dc"
-        message = "🗑️ Cleared your saved distribution center preference(s)."
-    elif "region" in text:
-        prefs = clear_user_pref(aad_id, "region")
-        cleared_key = "region"
-        message = "🗑️ Cleared your saved region preference(s)."
-    elif "all" in text or "prefs" in text or "preferences" in text:
-        prefs = clear_user_pref(aad_id, None)
-        cleared_key = "all"
-        message = "🗑️ All saved preferences have been reset."
-    else:
+    hits = {m.lastgroup for m in _CLEAR_TARGET_RE.finditer(question)}
+    target = next((t for t in _CLEAR_TARGETS if t in hits), None)
+    if target is None:
         return False
 
+    pref_key, cleared_key, message = _CLEAR_TARGETS[target]
+    prefs = clear_user_pref(aad_id, pref_key)
+
     # Build a natural summary of what’s left
     if prefs:
         remaining = []
@@ -921,36 +1458,50 @@ async def maybe_handle_clear_command(turn_context, aad_id: str, question: str) -
         message += " You now have no saved preferences."
 
     await turn_context.send_activity(message)
-    logger.info(f"User {aad_id} cleared {cleared_key} → remaining prefs {prefs}")
+    logger.info("User %s cleared %s → remaining prefs %s", aad_id, cleared_key, prefs)
     return True
 
-def extract_depts(question: str) -> list[str]:
-    import re, logging
-    logger = logging.getLogger(__name__)
+@lru_cache(maxsize=256)
+def _extracted(question: str) -> tuple[tuple[str, ...], tuple[str, ...], tuple[str, ...]]:
+    """
+    Pull (depts, dcs, regions) out of the question in a single pass.
+    Matches "dept 42", "dc7", "distribution center 4", "region great lakes".
+    Memoized: one turn asks for the same question several times.
+    """
+    found = {"dept": [], "dc": [], "region": []}
+    ends = {"dept": 0, "dc": 0, "region": 0}
+    for m in _ALL_PREFS_RE.finditer(question):
+        key = m.lastgroup
+        # keep findall's non-overlapping semantics within one key
+        if m.start() < ends[key]:
+            continue
+        ends[key] = m.end(key)
+        found[key].append(m.group(key))
+
+    logger.info("extract_depts: regex direct matches = %s", found["dept"])
+    if not found["dept"]:
+        combo = _DEPT_COMBO_RE.search(question)
+        if combo:
+            logger.info("extract_depts: fallback combo = %s", combo.group(1))
+            vals = _DEPT_SPLIT_RE.split(combo.group(1))
+            found["dept"] = [v.strip() for v in vals if v.strip().isdigit()]
+            logger.info("extract_depts: cleaned fallback = %s", found["dept"])
 
-    matches = re.findall(r"\b(?:dept|depts|department|departments)\s*(?:=)?\s*(\d+)", question, re.I)
-    logger.info(f"extract_depts: regex direct matches = {matches}")
+    regions = tuple(r.strip().upper() for r in found["region"])
+    return tuple(found["dept"]), tuple(found["dc"]), regions
 
-    if not matches:
-        combo = re.search(r"\b(?:dept|depts|department|departments)\s*(.+)", question, re.I)
-        if combo:
-            logger.info(f"extract_depts: fallback combo = {combo.group(1)}")
-            vals = re.split(r"[,\s]+and\s+|,|\s+and\s+", combo.group(1))
-            cleaned = [v.strip() for v in vals if v.strip().isdigit()]
-            logger.info(f"extract_depts: cleaned fallback = {cleaned}")
-            return cleaned
+def extract_all_prefs(question: str) -> dict[str, list[str]]:
+    depts, dcs, regions = _extracted(question)
+    return {"dept": list(depts), "dc": list(dcs), "region": list(regions)}
 
-    return matches
+def extract_depts(question: str) -> list[str]:
+    return list(_extracted(question)[0])
 
 def extract_dcs(question: str) -> list[str]:
-    # Match "dc7", "dc 7", "distribution center 4, 5"
-    matches = re.findall(r"\b(?:dc|distribution center)\s*(\d+)", question, re.I)
-    return matches
+    return list(_extracted(question)[1])
 
 def extract_regions(question: str) -> list[str]:
-    # Match "region east", "region=west", "region great lakes"
-    matches = re.findall(r"\bregion(?:s)?\s*(?:=)?\s*([a-zA-Z\s]+)", question, re.I)
-    return [m.strip().upper() for m in matches]
+    return list(_extracted(question)[2])
 
 def validate_pref(key: str, values: list[str]) -> tuple[list[str], list[str]]:
     """
@@ -961,15 +1512,23 @@ def validate_pref(key: str, values: list[str]) -> tuple[list[str], list[str]]:
     elif key == "dc":
         valid = [v for v in values if v in VALID_DCS]
     elif key == "region":
-        valid = [v.upper() for v in values if v.upper() in VALID_REGIONS]
+        valid = [u for u in map(str.upper, values) if u in VALID_REGIONS]
     else:
         return [], values
-    invalid = [v for v in values if v not in valid]
+    accepted = set(valid)
+    invalid = [v for v in values if v not in accepted]
     return valid, invalid
 
-def apply_user_prefs_to_prompt(system_prompt: str, prefs: dict, question: str) -> str:
+def apply_user_prefs_to_prompt(system_prompt: str, prefs: dict, question: str,
+                               extracted: dict | None = None) -> str:
+    # nothing saved and nothing mentioned: no filters to add
+    if not prefs and extracted is None and not _PREF_KEYWORD_RE.search(question):
+        return system_prompt
+    if extracted is None:
+        extracted = extract_all_prefs(question)
+
     # --- Dept ---
-    q_depts = extract_depts(question)
+    q_depts = extracted["dept"]
     if q_depts:
         valid, invalid = validate_pref("dept", q_depts)
         if valid:
@@ -985,7 +1544,7 @@ def apply_user_prefs_to_prompt(system_prompt: str, prefs: dict, question: str) -
             system_prompt += f"\nAlways filter by dept={val} unless user specifies otherwise."
 
     # --- DC ---
-    q_dcs = extract_dcs(question)
+    q_dcs = extracted["dc"]
     if q_dcs:
         valid, invalid = validate_pref("dc", q_dcs)
         if valid:
@@ -1000,7 +1559,7 @@ def apply_user_prefs_to_prompt(system_prompt: str, prefs: dict, question: str) -
             system_prompt += f"\nAlways filter by DC={val} unless user specifies otherwise."
 
     # --- Region ---
-    q_regions = extract_regions(question)
+    q_regions = extracted["region"]
     if q_regions:
         valid, invalid = validate_pref("region", q_regions)
         if valid:
@@ -1016,26 +1575,44 @@ def apply_user_prefs_to_prompt(system_prompt: str, prefs: dict, question: str) -
 
     return system_prompt
 
-def get_graph_user_details(aad_id: str, token: str) -> dict:
+# Graph calls share HTTP_SESSION with the Databricks helpers. Only the GET is
+# retried; the draft/attachment POSTs are sent once so a gateway error can't
+# leave duplicate drafts behind.
+GRAPH_ATTACH_TIMEOUT = aiohttp.ClientTimeout(total=60)
+# Graph rejects inline (base64) attachments over ~3 MB; larger files go
+# through an upload session in chunks that must be multiples of 320 KiB.
+GRAPH_INLINE_ATTACH_MAX = 3_000_000
+GRAPH_UPLOAD_CHUNK = 10 * 320 * 1024
+
+# aad_id -> Graph user object; profile fields don't change turn to turn
+GRAPH_USER_TTL = 600
+_GRAPH_USER_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=GRAPH_USER_TTL)
+
+async def get_graph_user_details(aad_id: str, token: str) -> dict:
     """
     Fetch full Graph user object using the user's AAD Object ID.
+    Successful lookups are cached for GRAPH_USER_TTL seconds.
     """
+    cached = _GRAPH_USER_CACHE.get(aad_id)
+    if cached is not None:
+        return cached
     try:
         headers = {"Authorization": f"Bearer {token}"}
         url = f"https://graph.microsoft.com/v1.0/users/{aad_id}"
-        resp = requests.get(url, headers=headers)
-        if resp.status_code == 200:
-            user_data = resp.json()
-            logger.debug(f"Graph user lookup for {aad_id}: displayName={user_data.get('displayName')} mail={user_data.get('mail')}")
+        status, text = await _http_text("GET", url, headers=headers)
+        if status == 200:
+            user_data = _jloads(text)
+            logger.debug("Graph user lookup for %s: displayName=%s mail=%s", aad_id, user_data.get('displayName'), user_data.get('mail'))
+            _GRAPH_USER_CACHE[aad_id] = user_data
             return user_data
         else:
-            logger.warning(f"Graph lookup failed for {aad_id}: {resp.text}")
+            logger.warning(f"Graph lookup failed for {aad_id}: {text}")
             return {}
     except Exception:
         logger.exception(f"Error calling Graph for {aad_id}")
         return {}
 
-def create_draft_via_graph(access_token: str, subject: str, html_body: str) -> Dict:
+async def create_draft_via_graph(access_token: str, subject: str, html_body: str) -> Dict:
     url = "https://graph.microsoft.com/v1.0/me/messages"
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     payload = {
@@ -1043,28 +1620,118 @@ def create_draft_via_graph(access_token: str, subject: str, html_body: str) -> D
         "body": { "contentType": "HTML", "content": html_body },
         "toRecipients": [], "ccRecipients": [], "bccRecipients": []
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=30)
-    r.raise_for_status()
-    return r.json()
-
-def attach_csv_via_graph(access_token: str, message_id: str, csv_bytes: bytes, filename: str = "results.csv") -> Dict:
+    async with HTTP_SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=HTTP_TIMEOUT) as r:
+        r.raise_for_status()
+        return _jloads(await r.read())
+
+async def attach_csv_via_graph(access_token: str, message_id: str, csv_bytes: bytes, filename: str = "results.csv") -> Dict:
+    if len(csv_bytes) > GRAPH_INLINE_ATTACH_MAX:
+        return await _upload_large_attachment(
+            access_token, message_id, io.BytesIO(csv_bytes), len(csv_bytes), filename
+        )
     url = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments"
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     payload = {
         "@odata.type": "#microsoft.graph.fileAttachment",
         "name": filename,
         "contentType": "text/csv",
-        "contentBytes": base64.b64encode(csv_bytes).decode()
+        "contentBytes": base64.b64encode(csv_bytes).decode("ascii")
+    }
+    async with HTTP_SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=GRAPH_ATTACH_TIMEOUT) as r:
+        r.raise_for_status()
+        return _jloads(await r.read())
+
+def _read_gzip_bytes(path: str) -> bytes:
+    with gzip.open(path, "rb") as f:
+        return f.read()
+
+def _gzip_inflated_size(path: str) -> int:
+    total = 0
+    with gzip.open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            total += len(chunk)
+    return total
+
+async def attach_csv_file_via_graph(access_token: str, message_id: str, gz_path: str, filename: str) -> Dict:
+    """
+    Attach a session .csv.gz (inflated). Small files go inline; larger ones are
+    streamed from disk in upload-session chunks so memory stays bounded.
+    """
+    total = await asyncio.to_thread(_gzip_inflated_size, gz_path)
+    if total <= GRAPH_INLINE_ATTACH_MAX:
+        csv_bytes = await asyncio.to_thread(_read_gzip_bytes, gz_path)
+        return await attach_csv_via_graph(access_token, message_id, csv_bytes, filename)
+    src = await asyncio.to_thread(gzip.open, gz_path, "rb")
+    try:
+        return await _upload_large_attachment(access_token, message_id, src, total, filename)
+    finally:
+        src.close()
+
+async def _upload_large_attachment(access_token: str, message_id: str, src, total: int, filename: str) -> Dict:
+    """
+    Stream `total` raw bytes from the binary file `src` to an attachment upload
+    session (no base64 copy, one chunk in memory at a time).
+    """
+    url = f"https://graph.microsoft.com/v1.0/me/messages/{message_id}/attachments/createUploadSession"
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    payload = {
+        "AttachmentItem": {
+            "attachmentType": "file",
+            "name": filename,
+            "size": total,
+            "contentType": "text/csv",
+        }
     }
-    r = requests.post(url, headers=headers, json=payload, timeout=60)
-    r.raise_for_status()
-    return r.json()
+    async with HTTP_SESSION.post(url, headers=headers, data=orjson.dumps(payload), timeout=HTTP_TIMEOUT) as r:
+        r.raise_for_status()
+        upload_url = _jloads(await r.read())["uploadUrl"]
+
+    # The upload URL is pre-authorized; Graph rejects an Authorization header here.
+    result: Dict = {}
+    for start in range(0, total, GRAPH_UPLOAD_CHUNK):
+        chunk = await asyncio.to_thread(src.read, GRAPH_UPLOAD_CHUNK)
+        if not chunk:
+            raise RuntimeError(f"Attachment source ended at byte {start} of {total}")
+        end = start + len(chunk) - 1
+        chunk_headers = {
+            "Content-Length": str(len(chunk)),
+            "Content-Range": f"bytes {start}-{end}/{total}",
+        }
+        async with HTTP_SESSION.put(upload_url, headers=chunk_headers, data=chunk,
+                                    timeout=GRAPH_ATTACH_TIMEOUT) as r:
+            r.raise_for_status()
+            body = await r.read()
+            if body:
+                result = _jloads(body)
+    return result
+
+
+# sqlparse's reindent is pure Python and gets slow on very long statements;
+# past this size only keywords are upper-cased.
+SQL_PRETTY_MAX_CHARS = 10_000
+_SQL_KEYWORDS = (
+    "select", "distinct", "from", "where", "group", "order", "by", "having",
+    "limit", "offset", "join", "inner", "left", "right", "full", "outer",
+    "cross", "on", "using", "as", "and", "or", "not", "in", "is", "null",
+    "like", "between", "case", "when", "then", "else", "end", "union", "all",
+    "intersect", "except", "with", "over", "partition", "asc", "desc",
+    "exists", "cast", "interval", "true", "false",
+)
+# String literals and quoted identifiers are matched first and left untouched.
+_SQL_KW_RE = re.compile(
+    r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\b(" + "|".join(_SQL_KEYWORDS) + r")\b",
+    re.IGNORECASE,
+)
 
+def _sql_kw_upper(m: re.Match) -> str:
+    return m.group(1).upper() if m.group(1) else m.group(0)
 
 def format_sql_for_card(raw_sql: str) -> str:
     """
     Prettify SQL for display (IDE-like). Falls back to raw on any error.
     """
+    if len(raw_sql or "") > SQL_PRETTY_MAX_CHARS:
+        return _SQL_KW_RE.sub(_sql_kw_upper, raw_sql).strip()
     try:
         return sqlparse.format(
             raw_sql or "",
@@ -1077,19 +1744,16 @@ def format_sql_for_card(raw_sql: str) -> str:
     except Exception:
         return raw_sql or ""
 
+_MD_ESCAPE_TABLE = str.maketrans({
+    "\\": "\\\\", "|": "\\|", "_": "\\_", "*": "\\*", "`": "\\`",
+})
+
 def escape_md_for_card(text: str) -> str:
     """
     Adaptive Card TextBlock parses a subset of Markdown. Escape chars that
     often break SQL (underscore/pipe/asterisk/backtick).
     """
-    return (
-        (text or "")
-        .replace("\\", "\\\\")
-        .replace("|", "\\|")
-        .replace("_", "\\_")
-        .replace("*", "\\*")
-        .replace("`", "\\`")
-    )
+    return (text or "").translate(_MD_ESCAPE_TABLE)
 
 def chunk_text(s: str, limit: int = 2400):
     """
@@ -1097,7 +1761,52 @@ def chunk_text(s: str, limit: int = 2400):
     (Teams/Adaptive Cards can truncate overly long TextBlocks.)
     """
     s = s or ""
-    return [s[i:i+limit] for i in range(0, len(s), limit)]
+    if len(s) <= limit:
+        return (s,) if s else ()      # common case: one block, no slicing loop
+    return (s[i:i+limit] for i in range(0, len(s), limit))
+
+# Static pieces of the SQL toggle card, built once and shared by reference
+# (never mutated; only the per-message lists around them are new).
+_SQL_CARD_TITLE = {"type": "TextBlock", "text": "**Generated SQL**", "weight": "Bolder"}
+_SQL_CARD_TOGGLE = {
+  "type": "Action.ToggleVisibility",
+  "title": "Show SQL",
+  "targetElements": ["sqlContainer"]
+}
+_SQL_CARD_HEAD = {
+  "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
+  "type": "AdaptiveCard",
+  "version": "1.5",
+}
+_CHART_URL = f"{DASH_URL}/chart?session={{session}}".format
+_EMAIL_URL = f"{BOT_URL}/graph/login?session={{session}}&user={{user}}".format
+_CSV_URL   = f"{BOT_URL}/download_csv?session={{session}}".format
+
+@lru_cache(maxsize=256)
+def _sql_card_blocks(raw_sql: str) -> tuple:
+    """
+    sqlparse + escape + chunk the SQL into card TextBlocks, once per distinct SQL
+    (re-sent cards, cache hits and follow-ups reuse the same statement).
+    """
+    pretty_sql = format_sql_for_card(raw_sql)
+    safe_sql   = escape_md_for_card(pretty_sql)
+    return tuple(
+        {
+          "type": "TextBlock",
+          "text": chunk,
+          "wrap": True,
+          "fontType": "Monospace",     # ← IDE-like look
+          "spacing": "Small"
+        } for chunk in chunk_text(safe_sql, limit=2400)
+    )
+
+@lru_cache(maxsize=256)
+def _sql_card_container(raw_sql: str) -> dict:
+    """Hidden SQL container for the card body; depends only on the SQL text."""
+    return {
+        "type": "Container", "id": "sqlContainer", "isVisible": False,
+        "items": [_SQL_CARD_TITLE, *_sql_card_blocks(raw_sql)],
+    }
 
 def build_sql_toggle_card(
     raw_sql: str,
@@ -1105,67 +1814,109 @@ def build_sql_toggle_card(
     truncated: bool,
     user_id: str
 ) -> Attachment:
-    pretty_sql = format_sql_for_card(raw_sql)
-    safe_sql   = escape_md_for_card(pretty_sql)
-    chunks     = chunk_text(safe_sql, limit=2400)
+    actions = [
+        _SQL_CARD_TOGGLE,
+        {"type": "Action.OpenUrl", "title": "Show Chart", "url": _CHART_URL(session=conversation_id)},
+        {"type": "Action.OpenUrl", "title": "Email Results",
+         "url": _EMAIL_URL(session=conversation_id, user=user_id)},
+    ]
+    if truncated:
+        actions.append(
+            {"type": "Action.OpenUrl", "title": "Download CSV", "url": _CSV_URL(session=conversation_id)}
+        )
 
-    # Base card
     card = {
-      "$schema": "http://adaptivecards.io/schemas/adaptive-card.json",
-      "type": "AdaptiveCard",
-      "version": "1.5",
-      "body": [
-        {
-          "type": "Container",
-          "id": "sqlContainer",
-          "isVisible": False,
-          "items": [
-            {"type": "TextBlock", "text": "**Generated SQL**", "weight": "Bolder"}
-          ] + [
-            {
-              "type": "TextBlock",
-              "text": chunk,
-              "wrap": True,
-              "fontType": "Monospace",     # ← IDE-like look
-              "spacing": "Small"
-            } for chunk in chunks
-          ]
-        }
-      ],
-      "actions": [
-        {
-          "type": "Action.ToggleVisibility",
-          "title": "Show SQL",
-          "targetElements": ["sqlContainer"]
-        },
-        {
-          "type":  "Action.OpenUrl",
-          "title": "Show Chart",
-          "url":   f"{DASH_URL}/chart?session={conversation_id}"
-        },
-        {
-          "type":  "Action.OpenUrl",
-          "title": "Email Results",
-          "url":   f"{BOT_URL}/graph/login?session={conversation_id}&user={user_id}"
-        }
-      ]
+      **_SQL_CARD_HEAD,
+      "body": [_sql_card_container((raw_sql or "").strip())],
+      "actions": actions,
     }
 
-    if truncated:
-        card["actions"].append({
-          "type":  "Action.OpenUrl",
-          "title": "Download CSV",
-          "url":   f"{BOT_URL}/download_csv?session={conversation_id}"
-        })
-
     return Attachment(
       content_type="application/vnd.microsoft.card.adaptive",
       content=card
     )
 
+_MD_FLOAT_TYPES = frozenset({"DECIMAL", "DOUBLE", "FLOAT"})
+_MD_INT_TYPES   = frozenset({"INT", "BIGINT", "LONG"})
+
+def _md_fmt_float(val) -> str:
+    return "NULL" if val is None else f"{float(val):,.2f}"
+
+def _md_fmt_int(val) -> str:
+    return "NULL" if val is None else f"{int(val):,}"
+
+def _md_fmt_str(val) -> str:
+    return "NULL" if val is None else str(val)
+
+# type_name -> cell formatter; anything unlisted renders with str()
+_MD_FORMATTERS: Dict[str, Callable[[object], str]] = {
+    **dict.fromkeys(_MD_FLOAT_TYPES, _md_fmt_float),
+    **dict.fromkeys(_MD_INT_TYPES, _md_fmt_int),
+}
+
+def _md_cell_formatter(type_name: Optional[str]) -> Callable[[object], str]:
+    """
+    Pick the markdown cell formatter for a column once, instead of per cell.
+    """
+    return _MD_FORMATTERS.get(type_name, _md_fmt_str)
+
+@lru_cache(maxsize=256)
+def _md_table_head(col_names: tuple) -> str:
+    """
+    Header + separator lines for a schema, cached since sessions repeat schemas.
+    """
+    header = "| " + " | ".join(col_names) + " |"
+    sep    = "|" + "|".join(" --- " for _ in col_names) + "|"
+    return header + "\n" + sep
+
+def _md_cell_expr(type_name: Optional[str], var: str) -> str:
+    """
+    Source expression that formats `var` like _md_cell_formatter(type_name) would.
+    """
+    if type_name in _MD_FLOAT_TYPES:
+        body = f"format(float({var}), ',.2f')"
+    elif type_name in _MD_INT_TYPES:
+        body = f"format(int({var}), ',')"
+    else:
+        body = f"str({var})"
+    return f"('NULL' if {var} is None else {body})"
+
+@lru_cache(maxsize=256)
+def _md_row_renderer(type_names: tuple) -> Callable[[list], str]:
+    """
+    Build (and cache per schema) a row -> markdown line renderer. The renderer is
+    generated as straight-line code for the column types, so there is no
+    per-cell dispatch at all; rows of the wrong width take the generic path.
+    """
+    formatters = tuple(_md_cell_formatter(t) for t in type_names)
+    ncols = len(formatters)
+
+    def fallback(row) -> str:
+        return "| " + " | ".join([fmt(val) for fmt, val in zip(formatters, row)]) + " |"
+
+    if not ncols:
+        return fallback
+
+    names = [f"v{i}" for i in range(ncols)]
+    cells = ", ".join(_md_cell_expr(t, v) for t, v in zip(type_names, names))
+    src = (
+        "def render(row):\n"
+        f"    if len(row) != {ncols}:\n"
+        "        return _fallback(row)\n"
+        f"    {', '.join(names)}, = row\n"
+        f"    return _tmpl({cells})\n"
+    )
+    namespace = {
+        "_fallback": fallback,
+        "_tmpl": ("| " + " | ".join(["{}"] * ncols) + " |").format,
+    }
+    exec(compile(src, "<md_row_renderer>", "exec"), namespace)
+    return namespace["render"]
+
 def process_query_results(answer_json: Dict) -> str:
     sections: List[str] = []
-    logger.info(f"Processing answer JSON: {answer_json}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Processing answer JSON: %s", answer_json)
 
     # 0) Plain-text summaries (e.g., "explain this dataset") come back as `message`
     msg = answer_json.get("message")
@@ -1212,34 +1963,22 @@ def process_query_results(answer_json: Dict) -> str:
         # if teams_truncated:
         #     notice_parts.append(f"Teams view cut {teams_truncated:,}")
         if csv_truncated:
-            notice_parts.append(f"CSV contains the first 5,000 rows of {db_total_rows:,} ({csv_truncated:,} rows are truncated)")
+            notice_parts.append(f"CSV contains the first {csv_rows:,} rows of {db_total_rows:,} ({csv_truncated:,} rows are truncated)")
     truncation_notice = "_" + " • ".join(notice_parts) + "._" if notice_parts else ""
 
     if rows and schema:
-        # build header
-        header = "| " + " | ".join(col["name"] for col in schema) + " |"
-        sep    = "|" + "|".join(" --- " for _ in schema) + "|"
-        table = [header, sep]
-
-        # populate rows
-        for row in rows:
-            out = []
-            for val, col in zip(row, schema):
-                if val is None:
-                    out.append("NULL")
-                elif col.get("type_name") in ("DECIMAL", "DOUBLE", "FLOAT"):
-                    out.append(f"{float(val):,.2f}")
-                elif col.get("type_name") in ("INT", "BIGINT", "LONG"):
-                    out.append(f"{int(val):,}")
-                else:
-                    out.append(str(val))
-            table.append("| " + " | ".join(out) + " |")
+        # build header — one pass over the schema for names and types
+        names, type_names = zip(*[(col["name"], col.get("type_name")) for col in schema])
+        head = _md_table_head(names)
+        render_row = _md_row_renderer(type_names)
 
-        results_block = "## Query Results\n\n"
+        # render rows straight into the block — no intermediate table list
+        prefix = "## Query Results\n\n"
         if truncation_notice:
-            results_block += truncation_notice + "\n\n"
-        results_block += "\n".join(table) + "\n"
-        sections.append(results_block)
+            prefix += truncation_notice + "\n\n"
+        sections.append(
+            prefix + "\n".join(chain((head,), map(render_row, rows))) + "\n"
+        )
 
                 # --- NEW: Supervisor Insights ---
         if LLM_SUPERVISOR_INSIGHTS_ENABLED:
@@ -1262,27 +2001,42 @@ def process_query_results(answer_json: Dict) -> str:
     # stitch and return
     return "\n".join(sections)
 
+_SAFE_MD_TABLE = str.maketrans({"|": "\\|", "_": "\\_"})
+
 def safe_md(text: str) -> str:
-    return text.replace("|", "\\|").replace("_", "\\_")
+    return text.translate(_SAFE_MD_TABLE)
 
 SETTINGS = BotFrameworkAdapterSettings(APP_ID, APP_PASSWORD)
 ADAPTER = BotFrameworkAdapter(SETTINGS)
 
 class MyBot(ActivityHandler):
+    __slots__ = ("conversation_ids", "user_state")
+
     def __init__(self):
-        self.conversation_ids: Dict[str, str] = {}
+        # user_id -> Genie conversation_id; idle conversations expire after a day
+        self.conversation_ids: TTLCache = TTLCache(maxsize=CONVERSATION_CACHE_MAX, ttl=CONVERSATION_TTL)
         self.user_state: Dict[str, Dict] = {}
 
     async def _typing_pump(self, turn_context: TurnContext, interval: float = TYPING_INTERVAL):
         """
-        Periodically send a 'typing' activity until cancelled.
+        Periodically send a 'typing' activity until cancelled. Each ping is a
+        Bot Framework POST, so failing channels are retried with back-off.
         """
+        delay = interval
         while True:
             try:
                 await turn_context.send_activity(Activity(type=ActivityTypes.typing))
+                delay = interval
             except Exception:
                 logger.exception("Typing pump failed to send typing activity")
-            await asyncio.sleep(interval)
+                delay = min(delay * 2, TYPING_MAX_INTERVAL)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _stop_typing(typing_task: asyncio.Task):
+        typing_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await typing_task
 
     async def on_message_activity(self, turn_context: TurnContext):
         from_prop = turn_context.activity.from_property
@@ -1290,13 +2044,10 @@ class MyBot(ActivityHandler):
         aad_id    = getattr(from_prop, "aad_object_id", None)           # Entra object id
         aad_name  = getattr(from_prop, "name", None) or "Unknown"       # display name fallback
 
-        try:
-            from storage import save_user_profile
-            logger.info(f"[USER] upserting UserPrefs for aad_id={aad_id} name={aad_name!r}")
-            save_user_profile(aad_id, aad_name)
-            logger.info("[USER] save_user_profile completed")
-        except Exception:
-            logger.exception(f"[USER] save_user_profile failed (aad_id={aad_id})")
+        if aad_id:
+            # queued on the storage pool; this turn doesn't wait on Table Storage
+            logger.info("[USER] queueing UserPrefs upsert for aad_id=%s name=%r", aad_id, aad_name)
+            save_user_profile_background(aad_id, aad_name)
 
         state = self.user_state.setdefault(user_id, {})
 
@@ -1330,35 +2081,44 @@ class MyBot(ActivityHandler):
                 state.pop("pending_pref", None)
                 return
 
-        if EXPLICIT_INTENT.search(question):
+        tokens = _question_tokens(question)
+        if has_explicit_intent(question, tokens):
             if await maybe_handle_pref_command(turn_context, aad_id, question):
                 return  # handled; skip Genie for this turn
             
-        if CLEAR_INTENT.search(question):
+        if has_clear_intent(question, tokens):
             if await maybe_handle_clear_command(turn_context, aad_id, question):
                 return  # handled; skip Genie for this turn
 
+        # Prefs feed both the Genie prompt and the suggestions below; load them
+        # off the event loop while the typing indicator starts.
+        prefs_task = asyncio.ensure_future(asyncio.to_thread(get_user_prefs, aad_id))
         typing_task = asyncio.create_task(self._typing_pump(turn_context, interval=TYPING_INTERVAL))
 
         try:
-            # 1) call Genie
+            # 1) call Genie (bounded by GENIE_SEM inside ask_genie, so bursts
+            #    queue here instead of at Databricks)
+            prefs = await prefs_task
             answer, new_conversation_id = await ask_genie(
                 question,
                 DATABRICKS_SPACE_ID,
                 self.conversation_ids.get(user_id),
                 aad_id=aad_id,
+                prefs=prefs,
             )
             self.conversation_ids[user_id] = new_conversation_id
+            # the answer is ready; stop pinging before the replies go out
+            await self._stop_typing(typing_task)
 
             # 2) parse JSON
-            answer_json = json.loads(answer)
+            answer_json = _jloads(answer)
 
             # map of preference keys to the trigger words we’ll look for in the question
-            prefs = get_user_prefs(aad_id)
-            logger.info(f"Loaded prefs for {aad_id}: {prefs}")
+            logger.info("Loaded prefs for %s: %s", aad_id, prefs)
+            mentioned = extract_all_prefs(question)
             if not state.get("pending_pref"):
                 if "dept" not in prefs:
-                    vals = extract_depts(question)
+                    vals = mentioned["dept"]
                     if vals:
                         # normalize the key before saving
                         key = KEY_NORMALIZATION.get("dept", "dept")
@@ -1366,7 +2126,7 @@ class MyBot(ActivityHandler):
                         if not valid:
                             await turn_context.send_activity(
                                 f"⚠️ I didn’t recognize dept(s): {', '.join(invalid)}. "
-                                f"Valid values are: {', '.join(sorted(VALID_DEPTS))}."
+                                f"Valid values are: {VALID_DEPTS_SORTED_STR}."
                             )
                         else:
                             state["pending_pref"] = {"key": key, "value": valid}
@@ -1377,21 +2137,22 @@ class MyBot(ActivityHandler):
                                     f"(Reply `yes` or `no` to confirm.)"
                                 )
                             else:
+                                joined = ", ".join(valid)
                                 await turn_context.send_activity(
-                                    f"💡 I noticed you mentioned dept(s) {', '.join(valid)} in this query. "
-                                    f"Want me to remember {', '.join(valid)} as your default dept(s)?\n"
+                                    f"💡 I noticed you mentioned dept(s) {joined} in this query. "
+                                    f"Want me to remember {joined} as your default dept(s)?\n"
                                     f"(Reply `yes` or `no` to confirm.)"
                                 )
 
             if "dc" not in prefs:
-                vals = extract_dcs(question)
+                vals = mentioned["dc"]
                 if vals:
                     key = KEY_NORMALIZATION.get("dc", "dc")
                     valid, invalid = validate_pref(key, vals)
                     if not valid:
                         await turn_context.send_activity(
                             f"⚠️ I didn’t recognize DC(s): {', '.join(invalid)}. "
-                            f"Valid values are: {', '.join(sorted(VALID_DCS))}."
+                            f"Valid values are: {VALID_DCS_SORTED_STR}."
                         )
                     else:
                         state["pending_pref"] = {"key": key, "value": valid}
@@ -1402,21 +2163,22 @@ class MyBot(ActivityHandler):
                                 f"(Reply `yes` or `no` to confirm.)"
                             )
                         else:
+                            joined = ", ".join(valid)
                             await turn_context.send_activity(
-                                f"💡 I noticed you mentioned DC(s) {', '.join(valid)} in this query. "
-                                f"Want me to remember {', '.join(valid)} as your default DC(s)?\n"
+                                f"💡 I noticed you mentioned DC(s) {joined} in this query. "
+                                f"Want me to remember {joined} as your default DC(s)?\n"
                                 f"(Reply `yes` or `no` to confirm.)"
                             )
 
                 if "region" not in prefs:
-                    vals = extract_regions(question)
+                    vals = mentioned["region"]
                     if vals:
                         key = KEY_NORMALIZATION.get("region", "region")
                         valid, invalid = validate_pref(key, vals)
                         if not valid:
                             await turn_context.send_activity(
                                 f"⚠️ I didn’t recognize region(s): {', '.join(invalid)}. "
-                                f"Valid values are: {', '.join(sorted(VALID_REGIONS))}."
+                                f"Valid values are: {VALID_REGIONS_SORTED_STR}."
                             )
                         else:
                             state["pending_pref"] = {"key": key, "value": valid}
@@ -1427,9 +2189,10 @@ class MyBot(ActivityHandler):
                                     f"(Reply `yes` or `no` to confirm.)"
                                 )
                             else:
+                                joined = ", ".join(valid)
                                 await turn_context.send_activity(
-                                    f"💡 I noticed you mentioned region(s) {', '.join(valid)} in this query. "
-                                    f"Want me to remember {', '.join(valid)} as your default region(s)?\n"
+                                    f"💡 I noticed you mentioned region(s) {joined} in this query. "
+                                    f"Want me to remember {joined} as your default region(s)?\n"
                                     f"(Reply `yes` or `no` to confirm.)"
                                 )
 
@@ -1442,41 +2205,32 @@ class MyBot(ActivityHandler):
                 "aad_id": aad_id,
             }
 
-            token = _get_valid_access_token(user_id)
+            token = await _get_valid_access_token(user_id)
             if not token:
                 logger.warning(f"No Graph token available for user_id={user_id} aad_id={aad_id}")
             if token and aad_id:
-                graph_user = get_graph_user_details(aad_id, token)
+                graph_user = await get_graph_user_details(aad_id, token)
                 answer_json["user_info"]["graph_raw"] = graph_user
 
-            logger.info(f"Captured user info: {answer_json['user_info']}")
+            logger.info("Captured user info: %s", answer_json['user_info'])
 
-            # persist user profile + Graph enrichment into Table Storage
-            if aad_id and aad_name:
-                try:
-                    from storage import save_user_profile
-                    save_user_profile(aad_id, aad_name)
-                except Exception:
-                    logger.warning(f"Skipped saving user profile for {aad_id} until Application User.Read.All is granted")
-
-            # 3a) send plain‑text markdown (description + results)
+            # 3a) plain‑text markdown (description + results)
             plain_markdown = process_query_results(answer_json)
 
             plain_markdown += f"\n\n*Session ID: `{new_conversation_id}`*"
 
-            await turn_context.send_activity(plain_markdown)
-
-            # 3b) Send the SQL toggle card only if we actually have SQL
+            # 3b) Attach the SQL toggle card only if we actually have SQL,
+            #     and send both in a single activity
             raw_sql = answer_json.get("raw_sql", "") or ""
             if raw_sql.strip():
                 conversation  = self.conversation_ids[user_id]
                 truncated     = answer_json.get("truncated", False)
-                # If your build_sql_toggle_card now expects user_id too, pass it
-                # sql_card = build_sql_toggle_card(raw_sql, conversation, truncated, user_id)
                 sql_card = build_sql_toggle_card(raw_sql, conversation, truncated, user_id)
-                await turn_context.send_activity(MessageFactory.attachment(sql_card))
+                await turn_context.send_activity(MessageFactory.attachment(sql_card, text=plain_markdown))
+            else:
+                await turn_context.send_activity(plain_markdown)
 
-        except json.JSONDecodeError as jde:
+        except orjson.JSONDecodeError as jde:
             logger.exception("Failed to parse JSON from Genie")
             await turn_context.send_activity(
                 "⚠️ I got something I couldn’t understand back from Genie."
@@ -1490,9 +2244,7 @@ class MyBot(ActivityHandler):
                 "Please try again in a moment."
             )
         finally:
-            typing_task.cancel()
-            with suppress(asyncio.CancelledError):
-                await typing_task
+            await self._stop_typing(typing_task)
 
     async def on_members_added_activity(self, members_added: List[ChannelAccount], turn_context: TurnContext):
         for member in members_added:
@@ -1501,8 +2253,73 @@ class MyBot(ActivityHandler):
 
 BOT = MyBot()
 
+async def _summarize_cached(data: dict) -> dict:
+    """supervisor_summarize, memoized per statement_id (answers without one are not cached)."""
+    statement_id = (data.get("statement_response") or {}).get("statement_id")
+    if statement_id:
+        cached = SUMMARY_CACHE.get(statement_id)
+        if cached is not None:
+            return cached
+    # blocking OpenAI call; keep the loop serving other turns meanwhile
+    sup = await asyncio.to_thread(supervisor_summarize, data)
+    if statement_id:
+        SUMMARY_CACHE[statement_id] = sup
+    return sup
+
+async def _build_draft_payload(data: dict):
+    """
+    Everything expensive about a draft: supervisor summary and email bodies.
+    Returns (subject, html_body, plain_body, included_preview).
+    """
+    # ----- Supervisor (LLM) -----
+    try:
+        sup = await _summarize_cached(data)  # {'subject','summary_html','summary_text'}
+        subject_override = (sup.get("subject") or "").strip()
+        summary_html = (sup.get("summary_html") or "").strip()
+        summary_text = (sup.get("summary_text") or "").strip()
+    except Exception:
+        logger.exception("Supervisor failed; proceeding without overrides.")
+        subject_override = ""
+        summary_html = ""
+        summary_text = ""
+
+    # ----- Build bodies (use 50-row rule) -----
+    # Preview inline if TOTAL rows <= 50; otherwise no preview + attach CSV
+    plain_body, html_body, included_preview = build_email_bodies(data, preview_max=PREVIEW_MAX_ROWS)
+
+    # Subject: supervisor override if present; else your existing deterministic subject
+    subject = subject_override or build_business_subject(data)
+
+    # Inject executive summary ONLY if supervisor provided it (LLM enabled and succeeded)
+    if summary_html:
+        html_body = (
+            '<h2 style="margin:0 0 12px 0;">Executive Summary</h2>'
+            f'{summary_html}'
+        )
+    else:
+        # deterministic version
+        html_body = html_body
+
+    # Plain text body: if LLM summary exists, use only that; else fallback
+    if summary_text:
+        plain_body = (
+            "Executive Summary\n\n"
+            f"{summary_text}\n"
+        )
+    else:
+        plain_body = plain_body
+
+    if summary_text:
+        plain_body = (
+            "Executive Summary\n\n"
+            f"{summary_text}\n"
+            + ("-" * 24) + "\n"
+        ) + plain_body
+
+    return subject, html_body, plain_body, included_preview
+
 async def _create_draft_for_session(user_id: str, session: str) -> web.Response:
-    access_token = _get_valid_access_token(user_id)
+    access_token = await _get_valid_access_token(user_id)
     if not access_token:
         return web.Response(status=401, text="No cached token; interactive sign-in required.")
 
@@ -1512,9 +2329,8 @@ async def _create_draft_for_session(user_id: str, session: str) -> web.Response:
 
     # ---- idempotency key for this user+session
     key = f"{user_id}:{session}"
-    now = time.time()
     cached = DRAFTS_BY_KEY.get(key)
-    if cached and (now - cached.get("ts", 0) <= DRAFT_CACHE_TTL):
+    if cached:
         logger.info("Reusing recent draft for %s", key)
         web_link = cached["web_link"]
         html = f"""<!doctype html>
@@ -1531,7 +2347,7 @@ async def _create_draft_for_session(user_id: str, session: str) -> web.Response:
     async with lock:
         # Double-check inside the lock (another request may have created it)
         cached = DRAFTS_BY_KEY.get(key)
-        if cached and (time.time() - cached.get("ts", 0) <= DRAFT_CACHE_TTL):
+        if cached:
             logger.info("Reusing recent draft for %s (post-lock)", key)
             web_link = cached["web_link"]
             html = f"""<!doctype html>
@@ -1543,67 +2359,23 @@ async def _create_draft_for_session(user_id: str, session: str) -> web.Response:
             </body></html>"""
             return web.Response(text=html, content_type="text/html")
 
-                # ----- Supervisor (LLM) -----
-        try:
-            sup = supervisor_summarize(data)  # {'subject','summary_html','summary_text'}
-            subject_override = (sup.get("subject") or "").strip()
-            summary_html = (sup.get("summary_html") or "").strip()
-            summary_text = (sup.get("summary_text") or "").strip()
-        except Exception:
-            logger.exception("Supervisor failed; proceeding without overrides.")
-            subject_override = ""
-            summary_html = ""
-            summary_text = ""
-
-        # ----- Build bodies (use 50-row rule) -----
-        # Preview inline if TOTAL rows <= 50; otherwise no preview + attach CSV
-        plain_body, html_body, included_preview = build_email_bodies(data, preview_max=PREVIEW_MAX_ROWS)
-
-        # Subject: supervisor override if present; else your existing deterministic subject
-        subject = subject_override or build_business_subject(data)
-
-        # Inject executive summary ONLY if supervisor provided it (LLM enabled and succeeded)
-        if summary_html:
-            html_body = (
-                '<h2 style="margin:0 0 12px 0;">Executive Summary</h2>'
-                f'{summary_html}'
-            )
-        else:
-            # deterministic version
-            html_body = html_body
-
-        # Plain text body: if LLM summary exists, use only that; else fallback
-        if summary_text:
-            plain_body = (
-                "Executive Summary\n\n"
-                f"{summary_text}\n"
-            )
-        else:
-            plain_body = plain_body
-
-        if summary_text:
-            plain_body = (
-                "Executive Summary\n\n"
-                f"{summary_text}\n"
-                + ("-" * 24) + "\n"
-            ) + plain_body
+        subject, html_body, plain_body, included_preview = await _build_draft_payload(data)
 
         # ----- Create draft + optional CSV attachment (unchanged) -----
         try:
-            draft = create_draft_via_graph(access_token, subject, html_body)
+            draft = await create_draft_via_graph(access_token, subject, html_body)
             msg_id   = draft.get("id")
             web_link = draft.get("webLink")
 
             if not included_preview:
-                csv_path = SESSION_FILES.get(session)
+                csv_path = await _session_csv_path(session)
                 if csv_path and os.path.exists(csv_path):
-                    with open(csv_path, "rb") as f:
-                        csv_bytes = f.read()
-                    _ = attach_csv_via_graph(access_token, msg_id, csv_bytes, os.path.basename(csv_path))
+                    filename = os.path.basename(csv_path).removesuffix(".gz")
+                    _ = await attach_csv_file_via_graph(access_token, msg_id, csv_path, filename)
                 else:
                     logger.warning("CSV path missing for session %s; skipping attachment", session)
 
-            DRAFTS_BY_KEY[key] = {"msg_id": msg_id, "web_link": web_link, "ts": time.time()}
+            DRAFTS_BY_KEY[key] = {"msg_id": msg_id, "web_link": web_link}
 
         except Exception:
             logger.exception("Failed to create draft or attach CSV via Graph")
@@ -1625,9 +2397,9 @@ async def graph_login(request: web.Request) -> web.Response:
     user_id = request.query.get("user") or ""
     if not session or not user_id:
         return web.Response(status=400, text="Missing session or user.")
-    if _get_valid_access_token(user_id):
+    if await _get_valid_access_token(user_id):
         raise web.HTTPFound(f"{BOT_URL}/graph/draft?session={session}&user={user_id}")
-    state = json.dumps({"session": session, "user": user_id})
+    state = _jdumps({"session": session, "user": user_id})
     raise web.HTTPFound(_oauth_authorize_url(state))
 
 app.router.add_get("/graph/login", graph_login)
@@ -1649,14 +2421,14 @@ async def graph_callback(request: web.Request) -> web.Response:
     if not code or not state:
         return web.Response(status=400, text="Missing code or state.")
     try:
-        s = json.loads(state)
+        s = _jloads(state)
         session = s["session"]
         user_id = s["user"]
     except Exception:
         return web.Response(status=400, text="Invalid state")
 
     try:
-        tok = _oauth_token_request({
+        tok = await _oauth_token_request({
             "client_id": MS_CLIENT_ID,
             "scope": MS_SCOPES,
             "code": code,
@@ -1675,7 +2447,7 @@ app.router.add_get("/graph/callback", graph_callback)
 
 async def messages(req: web.Request) -> web.Response:
     if "application/json" in req.headers["Content-Type"]:
-        body = await req.json()
+        body = await req.json(loads=_jloads)
     else:
         return web.Response(status=415)
 
@@ -1685,7 +2457,12 @@ async def messages(req: web.Request) -> web.Response:
     try:
         response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
         if response:
-            return web.json_response(data=response.body, status=response.status)
+            # orjson bytes go straight into the response, no str round-trip
+            return web.Response(
+                body=orjson.dumps(response.body),
+                status=response.status,
+                content_type="application/json",
+            )
         return web.Response(status=201)
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}")
@@ -1698,19 +2475,35 @@ app.router.add_post("/api/messages", messages)
 # ────────────────────────────────────────────────────────────
 async def download_csv(request: web.Request) -> web.Response:
     session = request.query.get("session")
-    path    = SESSION_FILES.get(session)
+    path    = await _session_csv_path(session)
     if not path or not os.path.exists(path):
         return web.Response(status=404, text="No data for that session.")
 
     # Clean up after serving:
     # del SESSION_FILES[session]
 
-    return web.FileResponse(
-        path,
-        headers={
-            "Content-Disposition": f"attachment; filename=\"results_{session}.csv\""
-        }
-    )
+    headers = {
+        "Content-Type": "text/csv",
+        "Content-Disposition": f"attachment; filename=\"results_{session}.csv\"",
+        "Vary": "Accept-Encoding",
+    }
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        # stored gzipped; the client inflates it.
+        # FileResponse uses sendfile(2) when the transport allows; 64 KiB chunks otherwise
+        return web.FileResponse(
+            path,
+            chunk_size=1 << 16,
+            headers={**headers, "Content-Encoding": "gzip"},
+        )
+
+    # rare client without gzip support: inflate on the way out
+    resp = web.StreamResponse(headers=headers)
+    await resp.prepare(request)
+    with gzip.open(path, "rb") as f:
+        while chunk := f.read(1 << 16):
+            await resp.write(chunk)
+    await resp.write_eof()
+    return resp
 
 app.router.add_get("/download_csv", download_csv)
 
@@ -1722,7 +2515,8 @@ async def download_json(request: web.Request) -> web.Response:
     data    = SESSION_DATA.get(session)
     if not data:
         return web.Response(status=404, text="No data for that session.")
-    return web.json_response(data)
+    # orjson bytes go straight into the body; no str round-trip
+    return web.Response(body=orjson.dumps(data), content_type="application/json")
 
 app.router.add_get("/download_json", download_json)
 
@@ -1734,6 +2528,12 @@ if __name__ == "__main__":
     try:
         host = os.getenv("HOST", "localhost")
         port = int(os.environ.get("PORT", 3978))
-        web.run_app(app, host=host, port=port)
+        # gunicorn already runs GunicornUVLoopWebWorker; match it when run directly
+        try:
+            import uvloop
+            uvloop.install()
+        except ImportError:
+            pass
+        web.run_app(app, host=host, port=port, access_log=None)
     except Exception as error:
         logger.exception("Error running app")
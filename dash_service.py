@@ -1,10 +1,13 @@
 import os
-import json
+import orjson
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from flask import Flask, request
 from dash import Dash, dcc, html, Input, Output, State, dash_table
 import logging
+import threading
+from cachetools import TTLCache
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger("dash_service")
@@ -14,6 +17,58 @@ BOT_URL = os.environ["BOT_URL"]
 
 logger.info("Dash BOT_URL=%s", BOT_URL)
 
+# Reused keep-alive connection to the bot for every /download_json callback
+_HTTP = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(429, 503), raise_on_status=False),
+)
+_HTTP.mount("http://", _adapter)
+_HTTP.mount("https://", _adapter)
+
+# session -> (cols, column-major values, row arrays). Columns are kept by
+# position, never by name: Genie SQL can return duplicate names (two "count"
+# columns from a join). The bot reuses the
+# conversation id as the session across turns, so a page load always refetches
+# and only the chart/axis callbacks that follow are served from here.
+_SESSION_JSON: TTLCache = TTLCache(maxsize=256, ttl=300)
+_SESSION_LOCK = threading.Lock()
+
+def _fetch_session_payload(session):
+    """GET /download_json for the session and cache the derived chart inputs."""
+    resp = _HTTP.get(f"{BOT_URL}/download_json", params={"session": session})
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("🛰️ /download_json status=%s body=%s…", resp.status_code, resp.text[:200])
+    if resp.status_code != 200:
+        logger.warning("download_json returned %s for session=%s", resp.status_code, session)
+        with _SESSION_LOCK:
+            _SESSION_JSON.pop(session, None)
+        return None
+    try:
+        data = orjson.loads(resp.content)
+        cols = [c["name"] for c in data["statement_response"]["manifest"]["schema"]["columns"]]
+        rows = data["statement_response"]["result"]["data_array"]
+    except Exception:
+        logger.exception("Failed to parse payload")
+        return None
+    width = len(cols)
+    if any(len(r) != width for r in rows):
+        # zip(*rows) would cut every row to the shortest one; pad/trim to the schema
+        logger.warning("Ragged rows for session=%s; normalizing to %d columns", session, width)
+        rows = [(list(r) + [None] * width)[:width] for r in rows]
+    # one transpose to column-major; the chart only ever needs two columns
+    columns = list(zip(*rows)) if rows else [() for _ in cols]
+    payload = (cols, columns, rows)
+    with _SESSION_LOCK:
+        _SESSION_JSON[session] = payload
+    return payload
+
+def _get_session_payload(session):
+    with _SESSION_LOCK:
+        payload = _SESSION_JSON.get(session)
+    return payload if payload is not None else _fetch_session_payload(session)
+
 # Flask server to host Dash
 server = Flask(__name__)
 
@@ -28,6 +83,8 @@ dash_app = Dash(
 dash_app.layout = html.Div([
     # This component lets you read the URL (including query string)
     dcc.Location(id="url", refresh=False),
+    # ?session=... pulled out once per page load (browser-side, see below)
+    dcc.Store(id="session-id"),
 
     html.Div(
         style={
@@ -85,6 +142,8 @@ dash_app.layout = html.Div([
 
      # 4) Data table placeholder
     html.H3("Underlying Data", style={"textAlign":"center","marginTop":"40px"}),
+    # rows travel as {"cols", "rows"} arrays; the browser expands them to records
+    dcc.Store(id="table-store"),
     dash_table.DataTable(
         id="data-table",
         columns=[],   # will be set in callback
@@ -94,6 +153,13 @@ dash_app.layout = html.Div([
         style_cell={"textAlign": "left", "padding": "5px"},
     ),
 ])
+# 0) Parse ?session= in the browser so the Python callbacks never re-parse the URL
+dash_app.clientside_callback(
+    "function(search) { return new URLSearchParams(search || '').get('session'); }",
+    Output("session-id", "data"),
+    Input("url", "search"),
+)
+
 # 1) Populate x‑col and y‑col options + initial values once we know the session
 
 @dash_app.callback(
@@ -103,25 +169,21 @@ dash_app.layout = html.Div([
       Output("y-col", "options"),
       Output("y-col", "value"),
     ],
-    Input("url", "search")
+    Input("session-id", "data")
 )
-def populate_column_dropdowns(url_search):
-    import urllib.parse
-    query   = urllib.parse.parse_qs((url_search or "").lstrip("?"))
-    session = query.get("session", [None])[0]
-
-    # fetch the raw JSON once
-    resp = requests.get(f"{BOT_URL}/download_json", params={"session": session})
-    if resp.status_code != 200:
+def populate_column_dropdowns(session):
+    # fetch fresh on page load; the chart callbacks below reuse this payload
+    payload = _fetch_session_payload(session) if session else None
+    if payload is None:
         return [], None, [], None
 
-    j = resp.json()
-    cols = [c["name"] for c in j["statement_response"]["manifest"]["schema"]["columns"]]
-    options = [{"label": c, "value": c} for c in cols]
+    cols = payload[0]
+    # values are column positions, so duplicate names stay distinct
+    options = [{"label": c, "value": i} for i, c in enumerate(cols)]
 
     # default to first two columns if available
-    x0 = cols[0] if len(cols) > 0 else None
-    y0 = cols[1] if len(cols) > 1 else None
+    x0 = 0 if len(cols) > 0 else None
+    y0 = 1 if len(cols) > 1 else None
 
     return options, x0, options, y0
 
@@ -130,138 +192,80 @@ def populate_column_dropdowns(url_search):
     [
       Output("main-chart", "figure"),
       Output("data-table", "columns"),
-      Output("data-table", "data"),
+      Output("table-store", "data"),
     ],
     [
       Input("chart-type", "value"),
       Input("x-col",       "value"),
       Input("y-col",       "value"),
     ],
-    [State("url", "search")]
+    [State("session-id", "data")]
 )
-def update_chart_and_table(chart_type, x_col, y_col, url_search):
-    logger.debug(f"Inputs → chart={chart_type!r}, x_col={x_col!r}, y_col={y_col!r}, url={url_search!r}")
-    import urllib.parse
+def update_chart_and_table(chart_type, x_col, y_col, session):
+    logger.debug("Inputs → chart=%r, x_col=%r, y_col=%r, session=%r", chart_type, x_col, y_col, session)
 
     def _empty():
         return {"data": [], "layout": {"margin": {"t": 30, "b": 50}}}, [], []
 
-    # parse ?session=...
-    query = urllib.parse.parse_qs((url_search or "").lstrip("?"))
-    session = query.get("session", [None])[0]
-    logger.debug(f"🛰️ Dash fetching JSON for session={session}")
+    logger.debug("🛰️ Dash fetching JSON for session=%s", session)
 
     if not session:
         logger.warning("No session provided in URL.")
         return _empty()
     
-    resp = requests.get(f"{BOT_URL}/download_json", params={"session": session})
-    logger.debug("GET %s/download_json?session=%s → %s", BOT_URL, session, resp.status_code)
-
-    resp = requests.get(f"{BOT_URL}/download_json", params={"session": session})
-    logger.debug(f"🛰️ /download_json status={resp.status_code} body={resp.text[:200]}…")
-    if resp.status_code != 200:
-        logger.warning("download_json returned %s for session=%s", resp.status_code, session)
-        return _empty()
-
-    try:
-        data = resp.json()
-        cols = [c["name"] for c in data["statement_response"]["manifest"]["schema"]["columns"]]
-        rows = data["statement_response"]["result"]["data_array"]
-    except Exception:
-        logger.exception("Failed to parse payload")
+    payload = _get_session_payload(session)
+    if payload is None:
         return _empty()
+    cols, columns, rows = payload
 
     if not cols or not rows:
         logger.warning("No columns or rows in payload")
         return _empty()
 
-    if not x_col or not y_col or x_col not in cols or y_col not in cols:
+    valid = range(len(cols))
+    if not isinstance(x_col, int) or not isinstance(y_col, int) or x_col not in valid or y_col not in valid:
         logger.warning("Invalid x/y selection x=%r y=%r; cols=%r", x_col, y_col, cols)
         return _empty()
 
-    import pandas as pd
-    df = pd.DataFrame(rows, columns=cols)
+    xs, ys = list(columns[x_col]), list(columns[y_col])
 
     if chart_type == "bar":
-        fig_data = [{"type": "bar", "x": df[x_col], "y": df[y_col]}]
+        fig_data = [{"type": "bar", "x": xs, "y": ys}]
     elif chart_type == "line":
-        fig_data = [{"type": "scatter", "mode": "lines", "x": df[x_col], "y": df[y_col]}]
+        fig_data = [{"type": "scatter", "mode": "lines", "x": xs, "y": ys}]
     else:
-        fig_data = [{"type": "pie", "labels": df[x_col], "values": df[y_col]}]
+        fig_data = [{"type": "pie", "labels": xs, "values": ys}]
 
     fig = {
         "data": fig_data,
         "layout": {
             "margin": {"t": 30, "b": 50},
-            "xaxis": {"title": x_col, "tickangle": -45},
-            "yaxis": {"title": y_col},
+            "xaxis": {"title": cols[x_col], "tickangle": -45},
+            "yaxis": {"title": cols[y_col]},
         },
     }
-    table_columns = [{"name": c, "id": c} for c in df.columns]
-    table_data    = df.to_dict("records")
-    return fig, table_columns, table_data
-
-# @dash_app.callback(
-#     [
-#       Output("main-chart", "figure"),
-#       Output("data-table", "columns"),
-#       Output("data-table", "data"),
-#     ],
-#     [
-#       Input("chart-type", "value"),
-#       Input("x-col",       "value"),
-#       Input("y-col",       "value"),
-#     ],
-#     [State("url", "search")]
-# )
-
-# def update_chart_and_table(chart_type, x_col, y_col, url_search):
-#     logger.debug(f"Inputs → chart={chart_type!r}, x_col={x_col!r}, y_col={y_col!r}, url={url_search!r}")
-#     import urllib.parse
-
-#     # parse out ?session=xxx
-#     query = urllib.parse.parse_qs((url_search or "").lstrip("?"))
-#     session = query.get("session", [None])[0]
-#     logger.debug(f"🛰️  Dash fetching JSON for session={session}")
-
-#     # fetch data
-#     resp = requests.get(f"{BOT_URL}/download_json", params={"session": session})
-#     logger.debug(f"🛰️  Response {resp.status_code}: {resp.text[:200]}…")
-
-#     if resp.status_code != 200 or not session:
-#         # nothing to chart
-#         return {"data": []}
-
-#     data = resp.json()
-#     cols = [c["name"] for c in data["statement_response"]["manifest"]["schema"]["columns"]]
-#     rows = data["statement_response"]["result"]["data_array"]
-#     df   = pd.DataFrame(rows, columns=cols)
-
-#     logger.debug("DF columns: %r", list(df.columns))
-#     logger.debug("Requested x_col=%r, y_col=%r", x_col, y_col)
-
-#     if chart_type == "bar":
-#         fig_data = [{"type": "bar",  "x": df[x_col], "y": df[y_col]}]
-#     elif chart_type == "line":
-#         fig_data = [{"type": "line", "x": df[x_col], "y": df[y_col]}]
-#     else:
-#         fig_data = [{"type": "pie",  "labels": df[x_col], "values": df[y_col]}]
-
-#     fig = {
-#       "data": fig_data,
-#       "layout": {
-#         "margin": {"t": 30, "b": 50},
-#         "xaxis": {"title": x_col, "tickangle": -45},
-#         "yaxis": {"title": y_col},
-#       }  
-#     }
-
-#     # prepare table columns+data
-#     table_columns = [{"name": c, "id": c} for c in df.columns]
-#     table_data    = df.to_dict("records")
-
-#     return fig, table_columns, table_data
+    # DataTable ids must be unique; use positions and show the names
+    table_columns = [{"name": c, "id": str(i)} for i, c in enumerate(cols)]
+    return fig, table_columns, {"cols": cols, "rows": rows}
+
+# Expand row arrays into the records DataTable wants, in the browser: the wire
+# payload carries each column name once instead of once per row.
+dash_app.clientside_callback(
+    """
+    function(store) {
+        if (!store || !store.rows) { return []; }
+        var cols = store.cols;
+        return store.rows.map(function(row) {
+            var rec = {};
+            // keyed by position to match the table's column ids
+            for (var i = 0; i < cols.length; i++) { rec[i] = row[i]; }
+            return rec;
+        });
+    }
+    """,
+    Output("data-table", "data"),
+    Input("table-store", "data"),
+)
 
 if __name__ == "__main__":
     # Use DASH_PORT env var or default to 8050
@@ -1,21 +1,66 @@
 import os, requests, logging
 import re
-import json
+import time
+import atexit
+import orjson
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from azure.data.tables import TableServiceClient, UpdateMode
-from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError,
+)
+from azure.core.pipeline.transport import RequestsTransport
 
 logger = logging.getLogger(__name__)
 
 TABLE_NAME = "BotUserPreferences"
 
+# aad_id -> prefs dict; prefs are read on every message but change rarely
+PREFS_CACHE_TTL = 60
+_prefs_cache: TTLCache = TTLCache(maxsize=1024, ttl=PREFS_CACHE_TTL)
+_prefs_lock = threading.Lock()
+
+# aad_id -> Graph (app) user object; only successful lookups are cached
+PROFILE_CACHE_TTL = 3600
+_profile_cache: TTLCache = TTLCache(maxsize=10_000, ttl=PROFILE_CACHE_TTL)
+_profile_lock = threading.Lock()
+# aad_id -> pending lookup, so concurrent misses for one user share a request
+_profile_inflight: dict = {}
+
 # ------------------------
 # Azure Table Storage setup
 # ------------------------
 _conn_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
-_service = TableServiceClient.from_connection_string(_conn_str)
+# Built on first use (not at import) and reused, so create_table_if_not_exists
+# runs once per process instead of once per operation.
+_table = None
+_table_lock = threading.Lock()
+# requests' default pool keeps 10 sockets per host; pref reads run on the default
+# thread pool and profile flushes on _write_exec, so give them room. No urllib3
+# retries here: the SDK's own retry policy already covers the table calls.
+_table_session = requests.Session()
+_table_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+_table_session.mount("https://", _table_adapter)
+_table_session.mount("http://", _table_adapter)  # Azurite/local emulator
 
 def _get_table():
-    return _service.create_table_if_not_exists(TABLE_NAME)
+    global _table
+    if _table is None:
+        with _table_lock:
+            if _table is None:
+                service = TableServiceClient.from_connection_string(
+                    _conn_str,
+                    transport=RequestsTransport(session=_table_session, session_owner=False),
+                )
+                _table = service.create_table_if_not_exists(TABLE_NAME)
+    return _table
+
+# Profile upserts are telemetry; they are flushed off the message path.
+_write_exec = ThreadPoolExecutor(max_workers=4, thread_name_prefix="table")
 
 def _log_http_error(where: str, err: Exception):
     if isinstance(err, HttpResponseError):
@@ -33,11 +78,29 @@ def _log_http_error(where: str, err: Exception):
 # ------------------------
 # App-only Graph auth
 # ------------------------
+# Keep-alive pool for login/Graph calls; 429/503 are retried with a short backoff
+# and otherwise returned as-is so the status checks below still apply.
+HTTP_TIMEOUT = (3, 10)   # (connect, read) seconds
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(429, 503), raise_on_status=False),
+))
+
 tenant_id = os.getenv("MS_TENANT_ID")
 client_id = os.getenv("MicrosoftAppId")
 client_secret = os.getenv("MicrosoftAppPassword")
 
+# client-credentials token, reused until 60s before it expires
+_app_token: tuple[str, float] | None = None
+_app_token_lock = threading.Lock()
+
 def get_app_graph_token() -> str:
+    global _app_token
+    with _app_token_lock:
+        if _app_token and time.monotonic() < _app_token[1]:
+            return _app_token[0]
     url = f"https://login.microsoftonline.com/{tenant_id}/oauth2/v2.0/token"
     data = {
         "grant_type": "client_credentials",
@@ -45,22 +108,59 @@ def get_app_graph_token() -> str:
         "client_secret": client_secret,  # don't log this
         "scope": "https://graph.microsoft.com/.default"
     }
-    logger.info(f"Graph token request: tenant={tenant_id}, client_id={client_id}, scope={data['scope']}")
-    resp = requests.post(url, data=data)
+    logger.info("Graph token request: tenant=%s, client_id=%s, scope=%s", tenant_id, client_id, data['scope'])
+    resp = _SESSION.post(url, data=data, timeout=HTTP_TIMEOUT)
     resp.raise_for_status()
-    token = resp.json()["access_token"]
+    body = orjson.loads(resp.content)
+    token = body["access_token"]
+    with _app_token_lock:
+        _app_token = (token, time.monotonic() + int(body.get("expires_in", 3600)) - 60)
     return token
 
+def _drop_app_graph_token():
+    global _app_token
+    with _app_token_lock:
+        _app_token = None
+
 def get_user_profile_app(aad_id: str) -> dict:
-    token = get_app_graph_token()
-    headers = {"Authorization": f"Bearer {token}"}
-    url = f"https://graph.microsoft.com/v1.0/users/{aad_id}"
+    with _profile_lock:
+        cached = _profile_cache.get(aad_id)
+        if cached is not None:
+            return cached
+        pending = _profile_inflight.get(aad_id)
+        if pending is None:
+            pending = _profile_inflight[aad_id] = Future()
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        return pending.result()
 
-    resp = requests.get(url, headers=headers)
+    try:
+        user = _fetch_user_profile_app(aad_id)
+    except BaseException as e:
+        pending.set_exception(e)
+        raise
+    else:
+        pending.set_result(user)
+        return user
+    finally:
+        with _profile_lock:
+            _profile_inflight.pop(aad_id, None)
+
+def _fetch_user_profile_app(aad_id: str) -> dict:
+    url = f"https://graph.microsoft.com/v1.0/users/{aad_id}"
+    resp = _SESSION.get(url, headers={"Authorization": f"Bearer {get_app_graph_token()}"}, timeout=HTTP_TIMEOUT)
+    if resp.status_code == 401:
+        # cached app token was revoked or rotated early; fetch a fresh one once
+        _drop_app_graph_token()
+        resp = _SESSION.get(url, headers={"Authorization": f"Bearer {get_app_graph_token()}"}, timeout=HTTP_TIMEOUT)
 
     if resp.status_code == 200:
-        user = resp.json()
-        logger.debug(f"Graph lookup for {aad_id}: displayName={user.get('displayName')} mail={user.get('mail')}")
+        user = orjson.loads(resp.content)
+        logger.debug("Graph lookup for %s: displayName=%s mail=%s", aad_id, user.get('displayName'), user.get('mail'))
+        with _profile_lock:
+            _profile_cache[aad_id] = user
         return user
     else:
         logger.error(
@@ -69,89 +169,252 @@ def get_user_profile_app(aad_id: str) -> dict:
         )
         return {}
 
-def save_user_profile(aad_id: str, name: str):
+GRAPH_BATCH_MAX = 20  # Graph $batch limit per request
+
+def _post_graph_batch(requests_: list[dict]):
+    url = "https://graph.microsoft.com/v1.0/$batch"
+    body = orjson.dumps({"requests": requests_})
+    headers = {"Content-Type": "application/json"}
+    resp = _SESSION.post(url, data=body, headers={**headers, "Authorization": f"Bearer {get_app_graph_token()}"}, timeout=HTTP_TIMEOUT)
+    if resp.status_code == 401:
+        _drop_app_graph_token()
+        resp = _SESSION.post(url, data=body, headers={**headers, "Authorization": f"Bearer {get_app_graph_token()}"}, timeout=HTTP_TIMEOUT)
+    return resp
+
+def get_user_profiles_app(aad_ids: list[str]) -> dict[str, dict]:
+    """
+    Graph (app) user objects for many users, 20 per $batch round trip.
+    Cached users are served from _profile_cache; failed lookups are left out.
+    """
+    found: dict[str, dict] = {}
+    missing = []
+    with _profile_lock:
+        for aad_id in dict.fromkeys(aad_ids):
+            cached = _profile_cache.get(aad_id)
+            if cached is not None:
+                found[aad_id] = cached
+            else:
+                missing.append(aad_id)
+
+    for i in range(0, len(missing), GRAPH_BATCH_MAX):
+        chunk = missing[i:i + GRAPH_BATCH_MAX]
+        resp = _post_graph_batch([
+            {"id": str(n), "method": "GET", "url": f"/users/{aad_id}"}
+            for n, aad_id in enumerate(chunk)
+        ])
+        if resp.status_code != 200:
+            logger.error("Graph (app) batch lookup failed. Status=%s, Body=%s", resp.status_code, resp.text)
+            continue
+        for item in orjson.loads(resp.content).get("responses", []):
+            aad_id = chunk[int(item["id"])]
+            if item.get("status") == 200:
+                found[aad_id] = item.get("body") or {}
+            else:
+                logger.error("Graph (app) lookup failed for %s. Status=%s", aad_id, item.get("status"))
+        with _profile_lock:
+            for aad_id in chunk:
+                if aad_id in found:
+                    _profile_cache[aad_id] = found[aad_id]
+    return found
+
+def _profile_entity(aad_id: str, name: str) -> dict:
+    """
+    MERGE patch for a user's profile row. The prefs columns are never part of the patch,
+    so existing prefs are left alone and readers treat a missing one as {}.
+    """
     graph_user = {}
     try:
         graph_user = get_user_profile_app(aad_id)
     except Exception:
         logger.exception(f"Graph enrichment raised exception for {aad_id} ({name})")
-        graph_user = {}
+    patch = {
+        "PartitionKey": "UserPrefs",
+        "RowKey": aad_id,
+        "displayName": name,
+    }
+    if graph_user:
+        patch["graphProfile"] = orjson.dumps(graph_user).decode()
+    return patch
 
-    t = _get_table()
+def save_user_profile(aad_id: str, name: str):
+    _get_table().upsert_entity(_profile_entity(aad_id, name), mode=UpdateMode.MERGE)
+    logger.info("Upserted profile for %s without altering prefs", aad_id)
+
+# Profile upserts are buffered and written as one transaction per flush; every
+# row lives in the "UserPrefs" partition, which is what a transaction requires.
+PROFILE_FLUSH_DELAY = 2.0   # seconds a profile may wait in the buffer
+PROFILE_BATCH_MAX = 100     # Azure Tables limit per transaction
+_pending_profiles: dict[str, str] = {}   # aad_id -> display name (latest wins)
+_pending_lock = threading.Lock()
+_flush_scheduled = False
 
+def _flush_profiles():
+    global _flush_scheduled
+    with _pending_lock:
+        pending = list(_pending_profiles.items())
+        _pending_profiles.clear()
+        _flush_scheduled = False
+    if not pending:
+        return
+    table = _get_table()
     try:
-        # Try to read existing row; if it exists, DO NOT touch userPrefs
-        e = t.get_entity("UserPrefs", aad_id)
-        patch = {
-            "PartitionKey": "UserPrefs",
-            "RowKey": aad_id,
-            "displayName": name,
-        }
-        if graph_user:
-            patch["graphProfile"] = json.dumps(graph_user)
-        t.upsert_entity(patch, mode=UpdateMode.MERGE)
-        logger.info(f"Updated profile for {aad_id} without altering userPrefs")
-    except ResourceNotFoundError:
-        # Create fresh row — only here we initialize userPrefs
-        entity = {
-            "PartitionKey": "UserPrefs",
-            "RowKey": aad_id,
-            "displayName": name,
-            "graphProfile": json.dumps(graph_user) if graph_user else None,
-            "userPrefs": "{}",
-        }
-        t.upsert_entity(entity, mode=UpdateMode.MERGE)  # insert/merge
-        logger.info(f"Created profile for {aad_id} with empty userPrefs")
+        # warm _profile_cache in $batch round trips; _profile_entity then hits it
+        get_user_profiles_app([aad_id for aad_id, _ in pending])
+    except Exception:
+        logger.exception("Graph batch enrichment failed; falling back to per-user lookups")
+    entities = [_profile_entity(aad_id, name) for aad_id, name in pending]
+    for i in range(0, len(entities), PROFILE_BATCH_MAX):
+        batch = entities[i:i + PROFILE_BATCH_MAX]
+        try:
+            table.submit_transaction([("upsert", e, {"mode": UpdateMode.MERGE}) for e in batch])
+            logger.info("Upserted %d profile(s) in one transaction", len(batch))
+        except Exception as err:
+            # one bad row fails the whole transaction; retry the rows one by one
+            _log_http_error("profile transaction", err)
+            for e in batch:
+                try:
+                    table.upsert_entity(e, mode=UpdateMode.MERGE)
+                except Exception as row_err:
+                    _log_http_error(f"save_user_profile {e['RowKey']}", row_err)
+
+def _flush_profiles_later():
+    time.sleep(PROFILE_FLUSH_DELAY)
+    _flush_profiles()
+
+def save_user_profile_background(aad_id: str, name: str) -> None:
+    """
+    Buffer a profile upsert and return immediately. The buffer is written after
+    PROFILE_FLUSH_DELAY or as soon as it holds PROFILE_BATCH_MAX users.
+    Failures are logged, never raised to the caller.
+    """
+    global _flush_scheduled
+    with _pending_lock:
+        _pending_profiles[aad_id] = name
+        full = len(_pending_profiles) >= PROFILE_BATCH_MAX
+        delayed = not _flush_scheduled and not full
+        if delayed:
+            _flush_scheduled = True
+    if full:
+        _write_exec.submit(_flush_profiles)
+    elif delayed:
+        _write_exec.submit(_flush_profiles_later)
+
+atexit.register(_flush_profiles)
+
+def _entity_prefs(entity) -> dict:
+    """
+    Prefs stored on a row. New writes keep raw orjson bytes in the binary
+    userPrefsBin column; rows written before that only have the userPrefs string.
+    """
+    if not entity:
+        return {}
+    return orjson.loads(entity.get("userPrefsBin") or entity.get("userPrefs") or b"{}")
+
+PREFS_WRITE_ATTEMPTS = 3  # optimistic retries before giving up on a contended row
+
+def _modify_prefs(aad_id: str, mutate) -> tuple[dict, bool]:
+    """
+    Read-modify-write of a user's prefs with ETag optimistic concurrency.
+    mutate(prefs, exists) returns the new prefs dict, or None to skip the write.
+    A concurrent writer (412 / row created meanwhile) makes us re-read and
+    reapply. Returns (prefs, written).
+    """
+    table = _get_table()
+    for _ in range(PREFS_WRITE_ATTEMPTS):
+        try:
+            entity = table.get_entity("UserPrefs", aad_id)
+        except ResourceNotFoundError:
+            entity = None  # profile row may still be queued
+        prefs = _entity_prefs(entity)
+        new_prefs = mutate(prefs, entity is not None)
+        if new_prefs is None:
+            return prefs, False
+
+        # MERGE only the prefs column; the profile columns are left untouched.
+        # bytes map to Edm.Binary, so the blob is stored without a str round trip.
+        patch = {"PartitionKey": "UserPrefs", "RowKey": aad_id, "userPrefsBin": orjson.dumps(new_prefs)}
+        try:
+            if entity is None:
+                table.create_entity(patch)
+            else:
+                table.update_entity(
+                    patch,
+                    mode=UpdateMode.MERGE,
+                    etag=entity.metadata["etag"],
+                    match_condition=MatchConditions.IfNotModified,
+                )
+        except (ResourceModifiedError, ResourceExistsError):
+            logger.info("Prefs row for %s changed underneath us; retrying", aad_id)
+            continue
+        with _prefs_lock:
+            _prefs_cache.pop(aad_id, None)
+        return new_prefs, True
+    raise RuntimeError(f"Prefs update for {aad_id} lost {PREFS_WRITE_ATTEMPTS} races in a row")
 
 def save_user_pref(aad_id: str, key: str, value: str | list[str]) -> dict:
     """
     Save or update a single user preference.
     Handles both single string values and lists of strings.
     """
-    table = _get_table()
-    entity = table.get_entity("UserPrefs", aad_id)
-    prefs = json.loads(entity.get("userPrefs", "{}"))
+    return save_user_prefs_bulk(aad_id, {key: value})
 
+def save_user_prefs_bulk(aad_id: str, mapping: dict[str, str | list[str]]) -> dict:
+    """
+    Save several preferences in one read and one conditional write, rather than
+    a get/update pair per key. Keys already holding the same value are no-ops.
+    """
     # Always normalize lists to a list type, not comma-joined strings
-    if isinstance(value, list):
-        prefs[key] = value
-    else:
-        prefs[key] = str(value)
+    updates = {k: (v if isinstance(v, list) else str(v)) for k, v in mapping.items()}
 
-    entity["userPrefs"] = json.dumps(prefs)
-    table = _get_table()
-    table.upsert_entity(entity)
-    logger.info(f"Updated {aad_id} prefs: {prefs}")
+    def mutate(prefs, exists):
+        if exists and all(k in prefs and prefs[k] == v for k, v in updates.items()):
+            return None
+        return {**prefs, **updates}
+
+    prefs, written = _modify_prefs(aad_id, mutate)
+    if written:
+        logger.info("Updated %s prefs: %s", aad_id, prefs)
+    else:
+        logger.info("Prefs for %s unchanged (%s); skipping write", aad_id, ", ".join(updates))
     return prefs
 
 def get_user_prefs(aad_id: str) -> dict:
     """
     Fetch preferences as dict.
     Values may be strings or lists depending on what was stored.
+    Cached for PREFS_CACHE_TTL seconds; returns a copy callers may modify.
     """
+    with _prefs_lock:
+        cached = _prefs_cache.get(aad_id)
+    if cached is not None:
+        return dict(cached)
     try:
         table = _get_table()
         entity = table.get_entity("UserPrefs", aad_id)
-        prefs = json.loads(entity.get("userPrefs", "{}"))
-        return prefs
+        prefs = _entity_prefs(entity)
+    except ResourceNotFoundError:
+        prefs = {}  # no row yet (the common case); cache that too
     except Exception:
-        return {}
+        return {}  # transient failure: don't cache, retry next time
+    with _prefs_lock:
+        _prefs_cache[aad_id] = prefs
+    return dict(prefs)
     
 def clear_user_pref(aad_id: str, key: str | None = None) -> dict:
     """
     Remove one preference (key) or all prefs for a user.
     Returns the updated prefs dict.
     """
-    table = _get_table()
-    entity = table.get_entity("UserPrefs", aad_id)
-    prefs = json.loads(entity.get("userPrefs", "{}"))
+    def mutate(prefs, exists):
+        if not exists:
+            return None  # nothing saved yet, nothing to clear
+        if not (key in prefs if key else prefs):
+            return None  # nothing to clear; skip the write
+        if key:
+            return {k: v for k, v in prefs.items() if k != key}
+        return {}  # wipe all
 
-    if key:
-        prefs.pop(key, None)
-    else:
-        prefs = {}  # wipe all
-
-    entity["userPrefs"] = json.dumps(prefs)
-    table.upsert_entity(entity)
-    logger.info(f"Cleared prefs for {aad_id}, key={key or 'ALL'} → {prefs}")
-    return prefs
\ No newline at end of file
+    prefs, written = _modify_prefs(aad_id, mutate)
+    if written:
+        logger.info("Cleared prefs for %s, key=%s → %s", aad_id, key or 'ALL', prefs)
+    return prefs
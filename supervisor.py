@@ -18,8 +18,11 @@ from __future__ import annotations
 from typing import Any, Dict, List
 import os
 import json
+import orjson
 import html
 import logging
+import re
+from functools import lru_cache
 import time
 
 logger = logging.getLogger(__name__)
@@ -36,12 +39,12 @@ try:
 except Exception:  # pragma: no cover
     OpenAI = None  # handled at call time
 
-import inspect
-from openai import OpenAI
-_client = OpenAI()
-import openai as _pkg
-logger.warning("SUP: chat.completions.create signature=%s",
-               inspect.signature(_client.chat.completions.create))
+@lru_cache(maxsize=1)
+def _get_client():
+    """One OpenAI client per process, built on first use; it reads OPENAI_API_KEY
+    from the environment and keeps its connection pool across calls."""
+    return OpenAI()
+
 
 def _first_json_object(text: str) -> str:
     """Return the first balanced {...} JSON object from a string, or ''."""
@@ -61,6 +64,33 @@ def _first_json_object(text: str) -> str:
                     return text[start:i+1]
     return ""
 
+_JSON_DECODER = json.JSONDecoder()
+
+def _parse_json_object(text: str) -> dict | None:
+    """
+    Parse the model's JSON reply. The common case is a bare object, which orjson
+    takes in one call; prose around it falls back to raw_decode from the first
+    "{", and only then to the brace scanner above.
+    """
+    if not text:
+        return None
+    try:
+        obj = orjson.loads(text)
+        if isinstance(obj, dict):
+            return obj
+    except orjson.JSONDecodeError:
+        pass
+    start = text.find("{")
+    if start != -1:
+        try:
+            obj, _ = _JSON_DECODER.raw_decode(text, start)
+            if isinstance(obj, dict):
+                return obj
+        except ValueError:
+            pass
+    blob = _first_json_object(text)
+    return orjson.loads(blob) if blob else None
+
 # ---------------- Sanitization ----------------
 # Keep HTML strictly limited; strip attributes and unknown tags
 _ALLOWED_TAGS = {"p", "ul", "li", "strong", "em"}
@@ -69,40 +99,60 @@ def _empty_overrides() -> dict[str, str]:
     # No subject override and no summary blocks.
     return {"subject": "", "summary_html": "", "summary_text": ""}
 
+# a "<" up to the next ">"; an unclosed "<" stays in the text and is escaped
+_TAG_RE = re.compile(r"<([^>]*)>")
+
 def _sanitize_html(s: str) -> str:
     if not s:
         return ""
+    # split() alternates text runs and tag bodies: [text, tag, text, tag, ..., text]
+    parts = _TAG_RE.split(s)
     out: List[str] = []
-    i, N = 0, len(s)
-    while i < N:
-        ch = s[i]
-        if ch != "<":
-            out.append(html.escape(ch))
-            i += 1
+    for k, part in enumerate(parts):
+        if not k % 2:
+            if part:
+                out.append(html.escape(part))
             continue
-        j = s.find(">", i + 1)
-        if j == -1:
-            out.append(html.escape(s[i:]))
-            break
-        token = s[i + 1 : j].strip()
+        token = part.strip()
         is_close = token.startswith("/")
-        tag = (token[1:] if is_close else token).split()[0].lower() if token else ""
+        words = (token[1:] if is_close else token).split()
+        tag = words[0].lower() if words else ""
         if tag in _ALLOWED_TAGS:
             out.append(f"</{tag}>" if is_close else f"<{tag}>")
         # else drop the tag entirely
-        i = j + 1
     return "".join(out)
 
 
 # ---------------- Packing dataset ----------------
+def _dumps_rows(obj) -> str:
+    """
+    JSON for prompt payloads: UTF-8, no ASCII escaping. numpy and datetime cells
+    serialize natively; anything else orjson can't handle (Decimal) becomes str
+    instead of failing the whole LLM call.
+    """
+    return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+# Bound what one wide or long-text result can add to the prompt
+SAMPLE_MAX_ROWS = 20
+SAMPLE_MAX_COLS = 40
+SAMPLE_CELL_MAX = 200   # chars per string cell
+
+def _clip_cell(v):
+    if isinstance(v, str) and len(v) > SAMPLE_CELL_MAX:
+        return v[:SAMPLE_CELL_MAX] + "…"
+    return v
+
 def _pack_dataset(answer_json: Dict[str, Any]) -> Dict[str, Any]:
     """
     Reduce the payload to what the model needs (schema + small sample + truncation note).
     """
     stmt = (answer_json.get("statement_response") or {})
     result = (stmt.get("result") or {})
-    rows = (result.get("data_array") or [])[:20]
-    cols = (((stmt.get("manifest") or {}).get("schema") or {}).get("columns") or [])
+    rows = [
+        [_clip_cell(v) for v in row[:SAMPLE_MAX_COLS]]
+        for row in (result.get("data_array") or [])[:SAMPLE_MAX_ROWS]
+    ]
+    cols = (((stmt.get("manifest") or {}).get("schema") or {}).get("columns") or [])[:SAMPLE_MAX_COLS]
     shown = answer_json.get("shown_rows")
     total = answer_json.get("db_total_rows")
     csv_rows = answer_json.get("csv_rows")  # used only for the note, not raw data
@@ -150,6 +200,71 @@ _SUPERVISOR_SCHEMA = {
 }
 
 
+# Re-running the same Genie question packs to the same payload; reuse the answer.
+# Failures raise, so lru_cache only ever keeps good summaries.
+@lru_cache(maxsize=256)
+def _summarize_payload(payload: str) -> tuple[str, str, str]:
+    client = _get_client()
+    prompt = (
+        _SUPERVISOR_SYSTEM
+        + "\n\n"
+        + "You will receive a JSON payload with dataset context.\n"
+        + "Return ONLY a JSON object with EXACTLY these keys:\n"
+        + "  - subject (string, <= 120 chars)\n"
+        + "  - summary_html (string; allowed tags: <p>, <ul>, <li>, <strong>, <em>)\n"
+        + "  - summary_text (string)\n"
+        + "No prose, no code fences, no extra keys.\n\n"
+        + "PAYLOAD:\n"
+        + payload
+    )
+
+    # 1) Responses API with a single string input (no content parts, no response_format)
+    resp = client.responses.create(
+        model=LLM_MODEL,
+        input=prompt,
+        max_output_tokens=800,   # supported on Responses API
+        # temperature omitted (defaults are fine in your runtime)
+    )
+
+    # 2) Collect response text (covers both modern and older SDK shapes)
+    text_out = ""
+    out = getattr(resp, "output", None)
+
+    if isinstance(out, list):
+        # Modern 1.x often returns a list of items with messages/content blocks
+        parts = []
+        for item in out:
+            if getattr(item, "type", "") == "message":
+                for c in getattr(item, "content", []) or []:
+                    t = getattr(c, "type", "")
+                    if t in ("output_text", "text"):
+                        parts.append(getattr(c, "text", "") or "")
+        text_out = "".join(parts).strip()
+
+    # Fallbacks: older shapes / convenience properties
+    if not text_out:
+        # Some builds expose convenience properties
+        text_out = getattr(resp, "output_text", "") or getattr(resp, "content", "") or ""
+        text_out = (text_out or "").strip()
+
+    # 3) Parse first JSON object from the text
+    parsed = _parse_json_object(text_out)
+    if not parsed:
+        logger.warning("SUP: no JSON found in Responses text (len=%s)", len(text_out))
+        raise ValueError("empty content")
+
+    # 4) Sanitize + validate
+    subject = (parsed.get("subject") or "").strip()[:120]
+    summary_html = _sanitize_html(parsed.get("summary_html") or "")
+    summary_text = (parsed.get("summary_text") or "").strip()
+
+    if not subject or not (summary_html and summary_text):
+        logger.warning("SUP: parsed JSON missing keys: %s",
+                    {k: parsed.get(k) for k in ("subject","summary_html","summary_text")})
+        raise ValueError("Supervisor output missing required fields")
+
+    return subject, summary_html, summary_text
+
 # ---------------- Public entry point ----------------
 def supervisor_summarize(answer_json: Dict[str, Any]) -> Dict[str, str]:
     """
@@ -169,76 +284,46 @@ def supervisor_summarize(answer_json: Dict[str, Any]) -> Dict[str, str]:
         logger.warning("OpenAI SDK missing; using no-op overrides.")
         return _empty_overrides()
 
-    try:
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))     
-        content = _pack_dataset(answer_json)
-        prompt = (
-            _SUPERVISOR_SYSTEM
-            + "\n\n"
-            + "You will receive a JSON payload with dataset context.\n"
-            + "Return ONLY a JSON object with EXACTLY these keys:\n"
-            + "  - subject (string, <= 120 chars)\n"
-            + "  - summary_html (string; allowed tags: <p>, <ul>, <li>, <strong>, <em>)\n"
-            + "  - summary_text (string)\n"
-            + "No prose, no code fences, no extra keys.\n\n"
-            + "PAYLOAD:\n"
-            + json.dumps(content, ensure_ascii=False)
-        )
-
-        # 1) Responses API with a single string input (no content parts, no response_format)
-        resp = client.responses.create(
-            model=LLM_MODEL,
-            input=prompt,
-            max_output_tokens=800,   # supported on Responses API
-            # temperature omitted (defaults are fine in your runtime)
-        )
-
-        # 2) Collect response text (covers both modern and older SDK shapes)
-        text_out = ""
-        out = getattr(resp, "output", None)
-
-        if isinstance(out, list):
-            # Modern 1.x often returns a list of items with messages/content blocks
-            parts = []
-            for item in out:
-                if getattr(item, "type", "") == "message":
-                    for c in getattr(item, "content", []) or []:
-                        t = getattr(c, "type", "")
-                        if t in ("output_text", "text"):
-                            parts.append(getattr(c, "text", "") or "")
-            text_out = "".join(parts).strip()
-
-        # Fallbacks: older shapes / convenience properties
-        if not text_out:
-            # Some builds expose convenience properties
-            text_out = getattr(resp, "output_text", "") or getattr(resp, "content", "") or ""
-            text_out = (text_out or "").strip()
-
-        # 3) Parse first JSON object from the text
-        blob = _first_json_object(text_out)
-        if not blob:
-            logger.warning("SUP: no JSON found in Responses text (len=%s)", len(text_out))
-            raise ValueError("empty content")
-
-        parsed = json.loads(blob)
-
-        # 4) Sanitize + validate
-        subject = (parsed.get("subject") or "").strip()[:120]
-        summary_html = _sanitize_html(parsed.get("summary_html") or "")
-        summary_text = (parsed.get("summary_text") or "").strip()
-
-        if not subject or not (summary_html and summary_text):
-            logger.warning("SUP: parsed JSON missing keys: %s",
-                        {k: parsed.get(k) for k in ("subject","summary_html","summary_text")})
-            raise ValueError("Supervisor output missing required fields")
+    content = _pack_dataset(answer_json)
+    if not content["rows_sample"]:
+        # the system prompt fixes the zero-row answer; no need to ask the model
+        return {
+            "subject": f"{ORG_NAME} – No matching results",
+            "summary_html": "<p>No matching results.</p>",
+            "summary_text": "No matching results.",
+        }
 
+    try:
+        payload = _dumps_rows(content)
+        subject, summary_html, summary_text = _summarize_payload(payload)
         return {"subject": subject, "summary_html": summary_html, "summary_text": summary_text}
-
     except Exception as e:
         logger.exception("LLM supervisor failed; using no-op overrides. Error: %s", e)
         return _empty_overrides()
     
 
+# supervisor_insights prompt; %s slots take the JSON-encoded schema and sample
+_INSIGHTS_TMPL = """
+        You are an experienced retail supply chain analyst. Your audience is inventory planners, buyers, supply chain analysts, 
+        and merchandise operations analysts who use this tool to locate product in the supply chain and determine where there 
+        are potential issues.
+
+        Your task is to review the provided data and generate 2–4 concise, high-value insights that go beyond description:
+        - Identify potential supply chain risks, delays, shortages, or imbalances.
+        - Highlight notable contributors (e.g., top vendors, DCs, SKUs, origins) driving issues or concentration of volume.
+        - Suggest practical next steps, possible root causes, or follow-up questions to explore.
+
+        Data schema: %s
+        Data sample (first 20 rows max): %s
+
+        Guidelines:
+        - Use bullet points.
+        - Business-friendly, plain English.
+        - Each point should either highlight a potential issue OR propose a potential action/question.
+        - Keep strictly grounded in the data provided (no assumptions or hallucinations).
+        - Do not include PII.
+        """
+
 def supervisor_insights(answer_json: dict) -> dict:
     """
     Generate business insights from Genie results.
@@ -268,27 +353,11 @@ def supervisor_insights(answer_json: dict) -> dict:
         if not data_sample or not schema:
             return {"insights_html": "", "insights_text": ""}
 
-        prompt = f"""
-        You are an experienced retail supply chain analyst. Your audience is inventory planners, buyers, supply chain analysts, 
-        and merchandise operations analysts who use this tool to locate product in the supply chain and determine where there 
-        are potential issues.
-
-        Your task is to review the provided data and generate 2–4 concise, high-value insights that go beyond description:
-        - Identify potential supply chain risks, delays, shortages, or imbalances.
-        - Highlight notable contributors (e.g., top vendors, DCs, SKUs, origins) driving issues or concentration of volume.
-        - Suggest practical next steps, possible root causes, or follow-up questions to explore.
-
-        Data schema: {schema}
-        Data sample (first 20 rows max): {data_sample[:20]}
-
-        Guidelines:
-        - Use bullet points.
-        - Business-friendly, plain English.
-        - Each point should either highlight a potential issue OR propose a potential action/question.
-        - Keep strictly grounded in the data provided (no assumptions or hallucinations).
-        - Do not include PII.
-        """
-        resp = _client.chat.completions.create(
+        prompt = _INSIGHTS_TMPL % (
+            _dumps_rows(schema),
+            _dumps_rows(data_sample[:20]),
+        )
+        resp = _get_client().chat.completions.create(
             model=LLM_MODEL,
             messages=[
                 {"role": "system", "content": "You generate business insights for retail supply chain data."},
@@ -298,9 +367,9 @@ def supervisor_insights(answer_json: dict) -> dict:
         )
 
         text_out = resp.choices[0].message.content.strip()
-        html_out = "<ul>" + "".join(
-            [f"<li>{line.strip()}</li>" for line in text_out.split("\n") if line.strip()]
-        ) + "</ul>"
+        # model text is untrusted: escape it; splitlines also covers \r\n
+        lines = (ln for ln in map(str.strip, text_out.splitlines()) if ln)
+        html_out = "<ul>" + "".join(f"<li>{html.escape(ln)}</li>" for ln in lines) + "</ul>"
 
         return {"insights_html": html_out, "insights_text": text_out}
 
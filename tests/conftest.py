@@ -0,0 +1,11 @@
+import os
+import sys
+
+# app.py reads these at import time; point them at harmless placeholders
+os.environ.setdefault("DASH_URL", "http://localhost:8050")
+os.environ.setdefault("BOT_URL", "http://localhost:3978")
+os.environ.setdefault("DATABRICKS_HOST", "https://example.cloud.databricks.com")
+os.environ.setdefault("DATABRICKS_TOKEN", "test-token")
+os.environ.setdefault("LLM_SUPERVISOR_ENABLED", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,40 @@
+import gzip
+import os
+
+import pytest
+
+import app
+
+CASES = {
+    "plain": (["a", "b"], [["1", "2"], ["x y", "z"]]),
+    "empty and null cells": (["a", "b", "c"], [["1", "", None], ["", None, "3"]]),
+    "header needs quotes": (["h1", "h,2"], [["1", "2"]]),
+    "ragged rows": (["a", "b"], [["1", "2", "3"], ["4", "5"]]),
+    "single column with empty cell": (["a"], [["1"], [""], [None]]),
+    "cell needs quotes": (["a", "b"], [["1", "b,c"], ['x"y', "2"]]),
+    "non-string cells": (["a", "b"], [[1, True], [2.5, False]]),
+    "no rows": (["a", "b"], []),
+}
+
+
+def _export(monkeypatch, min_rows, col_names, rows):
+    monkeypatch.setattr(app, "ARROW_CSV_MIN_ROWS", min_rows)
+    path = app._write_csv_gz(col_names, rows)
+    try:
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_arrow_and_csv_paths_write_identical_bytes(monkeypatch, name):
+    col_names, rows = CASES[name]
+    via_csv = _export(monkeypatch, 10**9, col_names, [list(r) for r in rows])
+    via_arrow = _export(monkeypatch, -1, col_names, [list(r) for r in rows])
+    assert via_arrow == via_csv
+
+
+def test_arrow_writer_rejects_ragged_rows(tmp_path):
+    with pytest.raises(ValueError):
+        app._write_csv_gz_arrow(str(tmp_path / "out.csv.gz"), ["a", "b"], [["1", "2", "3"], ["4", "5"]])
@@ -0,0 +1,66 @@
+import asyncio
+
+import app
+
+
+def test_queued_follow_up_does_not_hold_a_genie_slot(monkeypatch):
+    """
+    Two turns in conversation A and one in conversation B with GENIE_SEM=1:
+    while A's follow-up is queued behind A's first turn, B gets the slot first.
+    """
+    started = []
+    release = {}
+
+    async def fake_ask_genie(composed_question, space_id, conversation_id):
+        word = next(w for w in ("alpha", "bravo", "charlie") if w in composed_question)
+        started.append(word)
+        await release[word].wait()
+        return '{"ok": true}', conversation_id
+
+    async def scenario():
+        monkeypatch.setattr(app, "GENIE_SEM", asyncio.Semaphore(1))
+        monkeypatch.setattr(app, "_ask_genie", fake_ask_genie)
+        for word in ("alpha", "bravo", "charlie"):
+            release[word] = asyncio.Event()
+
+        first = asyncio.create_task(app.ask_genie("alpha", "space", "conv-a"))
+        await asyncio.sleep(0.01)
+        follow_up = asyncio.create_task(app.ask_genie("bravo", "space", "conv-a"))
+        await asyncio.sleep(0.01)
+        other = asyncio.create_task(app.ask_genie("charlie", "space", "conv-b"))
+        await asyncio.sleep(0.01)
+        assert started == ["alpha"]
+
+        release["alpha"].set()
+        await first
+        await asyncio.sleep(0.01)
+        # B was only waiting for the slot; A's follow-up was waiting on A's lock
+        assert started == ["alpha", "charlie"]
+
+        release["charlie"].set()
+        await other
+        release["bravo"].set()
+        await follow_up
+        assert started == ["alpha", "charlie", "bravo"]
+
+    asyncio.run(scenario())
+
+
+def test_loaded_prefs_are_used_without_a_second_lookup(monkeypatch):
+    def no_lookup(aad_id):
+        raise AssertionError("get_user_prefs called on the event loop")
+
+    seen = []
+
+    async def fake_ask_genie(composed_question, space_id, conversation_id):
+        seen.append(composed_question)
+        return '{"ok": true}', conversation_id
+
+    async def scenario():
+        monkeypatch.setattr(app, "GENIE_SEM", asyncio.Semaphore(1))
+        monkeypatch.setattr(app, "get_user_prefs", no_lookup)
+        monkeypatch.setattr(app, "_ask_genie", fake_ask_genie)
+        await app.ask_genie("show open orders", "space", "conv-p", aad_id="user-1", prefs={})
+
+    asyncio.run(scenario())
+    assert len(seen) == 1 and "show open orders" in seen[0]